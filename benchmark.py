@@ -0,0 +1,234 @@
+from generate_dump import ROOT_CATEGORY, SyntheticWiki, generate
+from script import (CategoryGraph, articlecollector, csvdump_extractor,
+                    local_selection, printTime, pruned_fingerprint,
+                    save_as_json, select_articles, stage_metrics)
+from functools import partial
+from multiprocessing import Process, Queue
+import filecmp
+import json
+import os
+import script
+import shutil
+import sys
+import time
+
+# User inputs
+# (categories, articles) of the synthetic dumps, one run per scale
+scales = [(1000, 10000), (5000, 50000), (20000, 200000)]
+# Depths of the closures of ROOT_CATEGORY selected at every scale
+depths = [3, 10]
+# Article dump read at every scale: "dump.xml" or "dump-multistream.xml.bz2"
+articleDump = "dump-multistream.xml.bz2"
+seed = 0
+# Folder the dumps and outputs are written to, removed afterwards unless
+# keepFiles
+workPath = os.path.join(os.path.abspath(os.path.dirname(__file__)),
+                        "benchmark")
+keepFiles = False
+# The metrics of every scale are saved to resultsFile. If baselineFile holds
+# the results of an earlier run, a scale with a higher peak RSS, or a stage
+# slower or raising the peak RSS more, than there by more than tolerance
+# fails the benchmark. Stages shorter than minSeconds, or raising the peak
+# RSS by less than minRssIncrease bytes, are not compared: that is mostly
+# noise
+resultsFile = os.path.join(workPath, "results.json")
+baselineFile = None
+tolerance = 1.25
+minSeconds = 0.1
+minRssIncrease = 8 * 1024 * 1024
+# ingestMemoryBytes of a second ingest at every scale, small enough to spill
+# many runs: its run merge must stay within it and give the same graph
+mergeBudget = 512 * 1024
+
+
+def put_result(queue, target, args):
+    queue.put(target(*args))
+
+
+def run_in_process(target, *args):
+    # Run target in a fresh process, so that the peak RSS of each scale is
+    # its own, and return its result
+    queue = Queue()
+    process = Process(target=put_result, args=(queue, target, args))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def generate_scale(path, categories, articles):
+    start = time.time()
+    wiki, rows = generate(path, categories, articles, seed,
+                          articleDump.endswith(".bz2"))
+    return {"categories": categories, "articles": articles,
+            "csv_rows": rows,
+            "csv_bytes": os.path.getsize(os.path.join(path, "join.csv")),
+            "dump_bytes": os.path.getsize(os.path.join(path, articleDump)),
+            "generate_seconds": round(time.time() - start, 3)}
+
+
+def closure_article_ids(wiki, maxdepth):
+    # The articles under ROOT_CATEGORY to maxdepth, from the generated
+    # categories rather than script.py's category graph
+    subcats = [[] for _ in wiki.names]
+    for c, parents in enumerate(wiki.parents):
+        for parent in parents:
+            subcats[parent].append(c)
+    depth = {0: 0}
+    level = [0]
+    for d in range(1, maxdepth + 1):
+        level = [s for c in level for s in subcats[c] if s not in depth]
+        for s in level:
+            depth.setdefault(s, d)
+    return set(page_id for page_id, title, cats in wiki.articles
+               if any(c in depth for c in cats))
+
+
+def run_stages(path, categories, articles):
+    # Ingest, select and collect the articles of every depth with the
+    # settings of script.py; returns the metrics of every stage and checks
+    # the selections against the generated categories
+    script.OUTPUT_ROOT_PATH = os.path.join(path, "output")
+    del stage_metrics[:]
+    graph = csvdump_extractor(os.path.join(path, "join.csv"), None,
+                              script.ingestWorkers, script.ingestMemoryBytes)
+    graph_path = os.path.join(path, "categories.graph")
+    graph.save(graph_path)
+    del graph
+    category_graph = CategoryGraph(graph_path)
+    build_selection = partial(local_selection, category_graph, None, None)
+    selections = [select_articles(ROOT_CATEGORY, depth,
+                                  pruned_fingerprint(category_graph, None),
+                                  build_selection)
+                  for depth in depths]
+    counts = articlecollector(
+        os.path.join(path, articleDump),
+        [(outpath, articleids) for outpath, articleids, pairs in selections],
+        script.scanWorkers, script.outputCodec, script.outputCompressLevel,
+        script.compressThreads, script.outputShards)
+    stages = list(stage_metrics)
+
+    wiki = SyntheticWiki(categories, articles, seed)
+    checks = []
+    for depth, (outpath, articleids, pairs), count in zip(depths, selections,
+                                                          counts):
+        expected = closure_article_ids(wiki, depth)
+        checks.append({"depth": depth, "articles": len(articleids),
+                       "extracted": count, "expected": len(expected),
+                       "ok": set(articleids) == expected and
+                       count == len(expected)})
+    return stages, checks
+
+
+def merge_check(path):
+    # Ingest the .csv dump again within mergeBudget and trace the memory of
+    # the run merge
+    script.RESOURCES_PATH = path
+    script.traceAllocations = True
+    del stage_metrics[:]
+    graph = csvdump_extractor(os.path.join(path, "join.csv"), None, 1,
+                              mergeBudget)
+    graph_path = os.path.join(path, "categories-external.graph")
+    graph.save(graph_path)
+    peak = [stage["peak_traced"] for stage in stage_metrics
+            if stage["stage"] == "Run merge"][0]
+    same = filecmp.cmp(graph_path, os.path.join(path, "categories.graph"),
+                       shallow=False)
+    return {"budget": mergeBudget, "runs": graph.runs, "peak_traced": peak,
+            "same_graph": same, "ok": same and peak <= mergeBudget}
+
+
+def print_scale(result):
+    print("\n%(categories)s categories, %(articles)s articles: "
+          "%(csv_rows)s .csv rows" % result)
+    print("%-24s %10s %9s %10s %9s %9s" % ("Stage", "Rows", "Seconds",
+                                           "Rows/s", "Peak MB", "+Peak MB"))
+    for stage in result["stages"]:
+        print("%-24s %10d %9.3f %10d %9.1f %9.1f" % (
+            stage["stage"], stage["rows"], stage["seconds"],
+            stage["rows_per_second"], (stage["peak_rss"] or 0) / 2 ** 20,
+            (stage["peak_rss_increase"] or 0) / 2 ** 20))
+    for check in result["checks"]:
+        print("Depth %(depth)s: %(articles)s articles selected, %(extracted)s "
+              "extracted, %(expected)s expected" % check +
+              ("" if check["ok"] else " MISMATCH"))
+    check = result["merge_check"]
+    print("Run merge of %s runs within %.1f MB: %.1f MB traced, %s graph" % (
+        check["runs"], check["budget"] / 2 ** 20,
+        check["peak_traced"] / 2 ** 20,
+        "same" if check["same_graph"] else "DIFFERENT") +
+        ("" if check["ok"] else " FAILED"))
+
+
+def scale_peak_rss(scale):
+    return max([stage["peak_rss"] or 0 for stage in scale["stages"]] + [0])
+
+
+def regressions(results, baseline):
+    # Scales and stages slower or bigger than in the baseline by more than
+    # tolerance
+    found = []
+    previous = {(scale["categories"], scale["articles"]): scale
+                for scale in baseline["scales"]}
+    for scale in results["scales"]:
+        old = previous.get((scale["categories"], scale["articles"]))
+        if old is None:
+            continue
+        name = "%s categories, %s articles" % (scale["categories"],
+                                               scale["articles"])
+        if scale_peak_rss(scale) > scale_peak_rss(old) * tolerance:
+            found.append("%s: peak RSS %.1f MB, was %.1f MB" % (
+                name, scale_peak_rss(scale) / 2 ** 20,
+                scale_peak_rss(old) / 2 ** 20))
+        for new, was in zip(scale["stages"], old["stages"]):
+            if new["stage"] != was["stage"]:
+                break
+            stage = "%s, %s" % (name, new["stage"])
+            if was["seconds"] >= minSeconds and \
+                    new["seconds"] > was["seconds"] * tolerance:
+                found.append("%s: %.3f s, was %.3f s" % (
+                    stage, new["seconds"], was["seconds"]))
+            # The stage's own memory: how much it raised the peak RSS
+            increase = new.get("peak_rss_increase") or 0
+            was_increase = was.get("peak_rss_increase") or 0
+            if max(increase, was_increase) >= minRssIncrease and \
+                    increase > was_increase * tolerance:
+                found.append("%s: raised the peak RSS by %.1f MB, was "
+                             "%.1f MB" % (stage, increase / 2 ** 20,
+                                          was_increase / 2 ** 20))
+    return found
+
+
+def main():
+    start = time.time()
+    results = {"depths": depths, "article_dump": articleDump, "scales": []}
+    for categories, articles in scales:
+        path = os.path.join(workPath, "%s-%s" % (categories, articles))
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        result = run_in_process(generate_scale, path, categories, articles)
+        result["stages"], result["checks"] = run_in_process(
+            run_stages, path, categories, articles)
+        result["merge_check"] = run_in_process(merge_check, path)
+        results["scales"].append(result)
+        print_scale(result)
+        if not keepFiles:
+            shutil.rmtree(path)
+    save_as_json(results, resultsFile)
+    printTime(start, time.time())
+
+    failed = [check for scale in results["scales"]
+              for check in scale["checks"] + [scale["merge_check"]]
+              if not check["ok"]]
+    if baselineFile is not None:
+        with open(baselineFile, encoding="utf-8") as f:
+            found = regressions(results, json.load(f))
+        for regression in found:
+            print("Regression: %s" % regression)
+        failed.extend(found)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+from script import (INPUT_FILEPATH_ARTICLES_XML_BZ2, TEXT_CLEANERS,
+                    iterpages, open_dump, page_xpaths, parse_fragment,
+                    printTime)
+import time
+
+# User inputs
+# Number of page texts read from the start of the article dump
+pageCount = 10000
+# Times every cleaner runs over all texts, the best run is reported
+repeat = 3
+
+
+def read_texts(path_articles_xml, n):
+    title_path, id_path, text_path = page_xpaths()
+    texts = []
+    with open_dump(path_articles_xml) as f:
+        for page_id, offset, data in iterpages(f):
+            text = text_path(parse_fragment(data)[0])[0].text
+            if text:
+                texts.append(text)
+                if len(texts) == n:
+                    break
+    return texts
+
+
+def time_cleaner(cleaner, texts):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        results = [cleaner(text) for text in texts]
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, results
+
+
+def main():
+    start = time.time()
+    texts = read_texts(INPUT_FILEPATH_ARTICLES_XML_BZ2, pageCount)
+    size = sum(len(text) for text in texts)
+    print("%d texts read (%.1f MB)" % (len(texts), size / 1e6))
+    printTime(start, time.time())
+
+    outputs = {}
+    for name, cleaner in sorted(TEXT_CLEANERS.items()):
+        elapsed, outputs[name] = time_cleaner(cleaner, texts)
+        print("%s: %.3f s, %.1f MB/s" % (name, elapsed,
+                                         size / 1e6 / max(elapsed, 1e-9)))
+
+    names = sorted(outputs)
+    for name in names[1:]:
+        differing = sum(1 for a, b in zip(outputs[names[0]], outputs[name])
+                        if a != b)
+        print("%s vs %s: %d of %d texts differ" % (names[0], name,
+                                                  differing, len(texts)))
+
+
+if __name__ == "__main__":
+    main()
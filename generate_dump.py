@@ -0,0 +1,276 @@
+from script import Header, printTime
+from xml.sax.saxutils import escape
+import bz2
+import itertools
+import math
+import os
+import random
+import time
+
+# User inputs
+# Folder the dumps are written to
+outputPath = os.path.join(os.path.abspath(os.path.dirname(__file__)),
+                          "resources", "synthetic")
+categoryCount = 1000
+articleCount = 10000
+# Mean size in bytes of a page text, sizes are log-normally distributed
+textBytes = 2000
+seed = 0
+# Also write the .xml.bz2 multistream dump and its index
+multistream = True
+
+ROOT_CATEGORY = "Root"
+# Subcategory links besides the spanning tree, per category: links sharing
+# subcategories, and links from a category up to one of its ancestors,
+# which close cycles
+SHARED_LINKS = 0.5
+CYCLE_LINKS = 0.02
+# Share of the articles in no category, and of extra File: rows in the .csv
+# dump (namespace 6, not in the article dump)
+UNCATEGORIZED = 0.05
+FILE_ROWS = 0.02
+FILE_LEN = 100
+CL_TYPES = {0: "page", 6: "file", 14: "subcat"}
+# Skew of the category popularity among articles (Zipf exponent)
+CATEGORY_SKEW = 0.8
+PAGES_PER_STREAM = 100
+
+# Titles exercising the quoting and escaping of the .csv dump and the XML
+CATEGORY_TITLES = ["Category_%d", 'Companies_of_"Town_%d"',
+                   "Cafés,_bars_and_pubs_%d", "Back\\slash_%d"]
+ARTICLE_TITLES = ["Article_%d", 'The_"Quoted"_%d', "Comma,_separated_%d",
+                  "Back\\slash_%d", "O'Brien_%d", "Café_%d",
+                  "Fish_&_chips_%d", "漢字_%d"]
+WORDS = ["the", "of", "category", "graph", "computer", "hardware", "company",
+         "river", "city", "album", "species", "football", "history", "dump"]
+SITEINFO = """<mediawiki xmlns="%s" version="0.10" xml:lang="en">
+  <siteinfo>
+    <sitename>Wikipedia</sitename>
+    <dbname>synthwiki</dbname>
+    <generator>generate_dump.py</generator>
+    <case>first-letter</case>
+    <namespaces>
+      <namespace key="0" case="first-letter" />
+      <namespace key="6" case="first-letter">File</namespace>
+      <namespace key="14" case="first-letter">Category</namespace>
+    </namespaces>
+  </siteinfo>
+""" % Header
+PAGE = """  <page>
+    <title>%s</title>
+    <ns>%d</ns>
+    <id>%d</id>
+    <revision>
+      <id>%d</id>
+      <timestamp>2019-01-01T00:00:00Z</timestamp>
+      <model>wikitext</model>
+      <format>text/x-wiki</format>
+      <text bytes="%d" xml:space="preserve">%s</text>
+    </revision>
+  </page>
+"""
+SITE_END = "</mediawiki>\n"
+
+
+class SyntheticWiki(object):
+    # A category graph and its articles: names[c], parents[c] and page_ids[c]
+    # per category index (0 is ROOT_CATEGORY), and the page id, title and
+    # category indexes of every article
+
+    def __init__(self, categories, articles, seed=0):
+        rng = random.Random(seed)
+        self.seed = seed
+        self.names = [ROOT_CATEGORY] + [
+            rng.choice(CATEGORY_TITLES) % c for c in range(1, categories)]
+        self.parents = [[] for _ in range(categories)]
+        # Spanning tree by preferential attachment: categories with many
+        # subcategories attract more, giving a skewed fan-out
+        tree_parent = [None] * categories
+        attach = [0]
+        for c in range(1, categories):
+            tree_parent[c] = rng.choice(attach)
+            self.parents[c].append(tree_parent[c])
+            attach.extend((tree_parent[c], c))
+        for _ in range(int(categories * SHARED_LINKS)):
+            child, parent = rng.randrange(1, categories), rng.choice(attach)
+            if parent < child and parent not in self.parents[child]:
+                self.parents[child].append(parent)
+        for _ in range(int(categories * CYCLE_LINKS)):
+            parent = rng.randrange(1, categories)
+            child = tree_parent[parent]
+            while child != 0 and rng.random() < 0.5:
+                child = tree_parent[child]
+            if child != 0 and parent not in self.parents[child]:
+                self.parents[child].append(parent)
+
+        popularity = list(range(categories))
+        rng.shuffle(popularity)
+        cum_weights = list(itertools.accumulate(
+            1 / (rank + 1) ** CATEGORY_SKEW for rank in popularity))
+        self.articles = []
+        for a in range(articles):
+            if rng.random() < UNCATEGORIZED:
+                cats = []
+            else:
+                cats = set(rng.choices(
+                    range(categories), cum_weights=cum_weights,
+                    k=min(1 + int(rng.expovariate(0.7)), categories)))
+            self.articles.append([rng.choice(ARTICLE_TITLES) % a,
+                                  sorted(cats)])
+        files = int(articles * FILE_ROWS)
+
+        # Page ids interleave categories, articles and files
+        ids = rng.sample(range(1, categories + articles + files + 1),
+                         categories + articles + files)
+        self.page_ids = ids[:categories]
+        for article, page_id in zip(self.articles, ids[categories:]):
+            article.insert(0, page_id)
+        self.files = [(page_id, "Image_%d.jpg" % page_id,
+                       rng.randrange(categories))
+                      for page_id in ids[categories + articles:]]
+
+    def pages(self):
+        # (page id, namespace, title, category indexes) in page id order
+        pages = [(page_id, 14, self.names[c], self.parents[c])
+                 for c, page_id in enumerate(self.page_ids)]
+        pages.extend((page_id, 0, title, cats)
+                     for page_id, title, cats in self.articles)
+        pages.sort()
+        return pages
+
+    def text(self, page_id, namespace, cats):
+        # Wiki text of a page, the same on every call
+        rng = random.Random(self.seed * 1000003 + page_id)
+        sigma = 1.0
+        size = int(rng.lognormvariate(math.log(textBytes) - sigma ** 2 / 2,
+                                      sigma))
+        parts = []
+        length = 0
+        while length < size:
+            r = rng.random()
+            word = rng.choice(WORDS)
+            if r < 0.08:
+                part = "[[%s]] " % word.capitalize()
+            elif r < 0.14:
+                part = "[[%s|%s]] " % (word.capitalize(), rng.choice(WORDS))
+            elif r < 0.16:
+                part = "[[File:%s_%d.jpg|thumb|A [[%s]] in %d]] " % (
+                    word, rng.randrange(1000), rng.choice(WORDS),
+                    rng.randrange(1900, 2020))
+            elif r < 0.17:
+                part = "&#%d; " % rng.randrange(32, 1000)
+            elif r < 0.18:
+                part = "{{cite web|url=http://example.org/%d}} " % (
+                    rng.randrange(10 ** 6))
+            elif r < 0.19:
+                part = "\n\n== %s ==\n" % word.capitalize()
+            else:
+                part = word + " "
+            parts.append(part)
+            length += len(part)
+        parts.extend("\n[[Category:%s]]" % self.names[c].replace("_", " ")
+                     for c in cats)
+        return "".join(parts)
+
+
+def csv_string(value):
+    # A string field as written by MySQL's SELECT ... INTO OUTFILE with
+    # FIELDS OPTIONALLY ENCLOSED BY '"', ESCAPED BY '\'
+    return '"%s"' % value.replace("\\", "\\\\").replace('"', '\\"').replace(
+        "\n", "\\\n")
+
+
+def csv_row(page_id, namespace, title, page_len, cl_to, cl_type):
+    # One row of the page and categorylinks join
+    return ",".join([
+        str(page_id), str(namespace), csv_string(title), '""', "0", "0", "0",
+        "0.%d" % page_id, '"20190101000000"', '"20190101000000"',
+        str(page_id + 10 ** 8), str(page_len), '"wikitext"', "\\N",
+        str(page_id), csv_string(cl_to),
+        csv_string(title.upper().replace("_", " ") + "\nSORTKEY"),
+        '"2019-01-01 00:00:00"', '""', '"uca-default-u-kn"',
+        csv_string(cl_type)]) + "\n"
+
+
+def write_join_csv(path, wiki):
+    rows = 0
+    pages = wiki.pages()
+    pages.extend((page_id, 6, title, [c]) for page_id, title, c in wiki.files)
+    pages.sort()
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        for page_id, namespace, title, cats in pages:
+            page_len = FILE_LEN if namespace == 6 else len(
+                wiki.text(page_id, namespace, cats).encode("utf-8"))
+            for c in cats:
+                f.write(csv_row(page_id, namespace, title, page_len,
+                                wiki.names[c], CL_TYPES[namespace]))
+                rows += 1
+    return rows
+
+
+def xml_pages(wiki):
+    # The <page> elements of the article dump, in page id order
+    for page_id, namespace, title, cats in wiki.pages():
+        text = wiki.text(page_id, namespace, cats)
+        title = title.replace("_", " ")
+        if namespace == 14:
+            title = "Category:" + title
+        yield page_id, title, PAGE % (
+            escape(title), namespace, page_id, page_id + 10 ** 8,
+            len(text.encode("utf-8")), escape(text))
+
+
+def write_xml_dump(path, wiki):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(SITEINFO)
+        for page_id, title, page in xml_pages(wiki):
+            f.write(page)
+        f.write(SITE_END)
+
+
+def write_multistream(path, path_index, wiki):
+    # One bz2 stream for the siteinfo, one per PAGES_PER_STREAM pages and
+    # one for the end, indexed as offset:page_id:title
+    with open(path, "wb") as f, \
+            bz2.open(path_index, "wt", encoding="utf-8") as index:
+        f.write(bz2.compress(SITEINFO.encode("utf-8")))
+        pages = xml_pages(wiki)
+        while True:
+            stream = list(itertools.islice(pages, PAGES_PER_STREAM))
+            if not stream:
+                break
+            offset = f.tell()
+            for page_id, title, page in stream:
+                index.write("%d:%d:%s\n" % (offset, page_id, title))
+            f.write(bz2.compress("".join(
+                page for page_id, title, page in stream).encode("utf-8")))
+        f.write(bz2.compress(SITE_END.encode("utf-8")))
+
+
+def generate(path, categories, articles, seed=0, bz2_dump=True):
+    # Write join.csv, dump.xml and optionally the multistream dump to path;
+    # returns the SyntheticWiki and the .csv rows written
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    wiki = SyntheticWiki(categories, articles, seed)
+    rows = write_join_csv(os.path.join(path, "join.csv"), wiki)
+    write_xml_dump(os.path.join(path, "dump.xml"), wiki)
+    if bz2_dump:
+        write_multistream(os.path.join(path, "dump-multistream.xml.bz2"),
+                          os.path.join(path,
+                                       "dump-multistream-index.txt.bz2"),
+                          wiki)
+    return wiki, rows
+
+
+def main():
+    start = time.time()
+    wiki, rows = generate(outputPath, categoryCount, articleCount, seed,
+                          multistream)
+    print("%s categories, %s articles, %s .csv rows written to %s" % (
+        categoryCount, articleCount, rows, outputPath))
+    printTime(start, time.time())
+
+
+if __name__ == "__main__":
+    main()
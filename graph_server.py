@@ -0,0 +1,193 @@
+from script import (ReachabilityIndex, Stage, closure_articles, csr_arrays,
+                    evaluate_selection, getcategorydepths,
+                    load_category_graph, normalize, parse_selection,
+                    pruned_fingerprint, save_selection, server_address)
+from array import array
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import os
+import socket
+import tempfile
+import urllib.parse
+
+# User inputs
+# Address to listen on: "host:port" or "unix:<path>" for a Unix socket
+serverAddress = "localhost:8765"
+
+
+class GraphService(object):
+    # Answers queries from the category graph loaded once, with the pruning
+    # and closure cache settings of script.py
+
+    def __init__(self):
+        self.graph, self.pruned, self.cache = load_category_graph()
+        self.fingerprint = pruned_fingerprint(self.graph, self.pruned)
+        self.page_offsets = None
+
+    def category_id(self, name):
+        id = self.graph.id(normalize(name))
+        if id == -1:
+            raise KeyError("Unknown category: %s" % name)
+        return id
+
+    def info(self):
+        return {"fingerprint": self.fingerprint, "categories": len(self.graph)}
+
+    def closure(self, category, depth):
+        self.category_id(category)
+        return getcategorydepths(self.graph, normalize(category), depth,
+                                 self.cache, self.pruned)
+
+    def depth(self, category, root, maxdepth):
+        if isinstance(self.cache, ReachabilityIndex) and \
+                maxdepth <= self.cache.maxdepth:
+            depth = self.cache.depth(self.category_id(root),
+                                     self.category_id(category))
+            return {"depth": depth if depth is not None and depth <= maxdepth
+                    else None}
+        return {"depth": self.closure(root, maxdepth).get(normalize(category))}
+
+    def closure_articles(self, category, depth):
+        self.category_id(category)
+        return closure_articles(self.graph, self.cache, self.pruned,
+                                category, depth)
+
+    def articles(self, category, depth):
+        return bytes(self.closure_articles(category, depth).bits)
+
+    def select(self, expression):
+        # Articles of a selection expression, see parse_selection
+        return bytes(evaluate_selection(parse_selection(expression),
+                                        self.closure_articles).bits)
+
+    def page_categories(self, page_id):
+        # Inverse of the membership index, built on the first page query
+        if self.page_offsets is None:
+            with Stage("Page index", "pairs") as stage:
+                cats = array("i")
+                for id in range(len(self.graph)):
+                    cats.extend([id] * len(self.graph.members(id)))
+                pages = self.graph.member_ids
+                self.page_offsets, self.page_cats = csr_arrays(
+                    pages, cats, max(pages, default=-1) + 1, "i")
+                stage.add(len(cats))
+        if not 0 <= page_id < len(self.page_offsets) - 1:
+            return []
+        return self.page_cats[self.page_offsets[page_id]:
+                              self.page_offsets[page_id + 1]].tolist()
+
+    def categories(self, page):
+        return [self.graph.name(id) for id in self.page_categories(page)]
+
+    def roots(self, page, roots, depth):
+        cats = set(self.categories(page))
+        return [root for root in roots
+                if not cats.isdisjoint(self.closure(root, depth))]
+
+    def selection(self, category, depth):
+        fd, path = tempfile.mkstemp(suffix=".store")
+        os.close(fd)
+        try:
+            save_selection(path, self.graph, self.closure(category, depth),
+                           {"wantedcategory": category, "maxdepth": depth})
+            with open(path, "rb") as f:
+                return f.read()
+        finally:
+            os.remove(path)
+
+
+def depth(value):
+    depth = int(value)
+    if depth < 0:
+        raise ValueError("negative depth: %s" % value)
+    return depth
+
+
+# Query (a GraphService method) -> its parameters as (name, type, repeated)
+QUERIES = {
+    "info": [],
+    "closure": [("category", str, False), ("depth", depth, False)],
+    "depth": [("category", str, False), ("root", str, False),
+              ("maxdepth", depth, False)],
+    "articles": [("category", str, False), ("depth", depth, False)],
+    "select": [("expression", str, False)],
+    "categories": [("page", int, False)],
+    "roots": [("page", int, False), ("root", str, True),
+              ("depth", depth, False)],
+    "selection": [("category", str, False), ("depth", depth, False)]}
+
+
+class GraphRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = url.path.strip("/")
+        parameters = QUERIES.get(query)
+        if parameters is None:
+            return self.reply(404, "Unknown query: %s" % url.path)
+        values = urllib.parse.parse_qs(url.query)
+        try:
+            args = [[type(v) for v in values.get(name, [])] if repeated
+                    else type(values[name][0])
+                    for name, type, repeated in parameters]
+        except (KeyError, ValueError) as e:
+            return self.reply(400, "Bad parameters: %s" % e)
+        try:
+            result = getattr(self.server.service, query)(*args)
+        except KeyError as e:
+            return self.reply(404, e.args[0])
+        except ValueError as e:
+            return self.reply(400, str(e))
+        except Exception as e:
+            self.log_error("%s failed: %r", self.path, e)
+            return self.reply(500, "%s: %s" % (type(e).__name__, e))
+        self.reply(200, result)
+
+    def reply(self, status, result):
+        if isinstance(result, bytes):
+            content_type = "application/octet-stream"
+        elif isinstance(result, str) and status != 200:
+            content_type = "text/plain"
+            result = result.encode("utf-8")
+        else:
+            content_type = "application/json"
+            result = json.dumps(result).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(result)))
+        self.end_headers()
+        self.wfile.write(result)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+
+class UnixHTTPServer(HTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        self.socket.bind(self.server_address)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+
+def main():
+    address = server_address(serverAddress)
+    service = GraphService()
+    server = (UnixHTTPServer if isinstance(address, str) else HTTPServer)(
+        address, GraphRequestHandler)
+    server.service = service
+    print("Serving %s categories on %s" % (len(service.graph), serverAddress))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
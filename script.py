@@ -1,43 +1,142 @@
 from collections import defaultdict
 from lxml import etree
-from queue import PriorityQueue
 from bz2file import BZ2File
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from functools import partial
+from multiprocessing import Pool
+from queue import Full, Queue
+from threading import Event, Thread
+from xml.sax.saxutils import escape
+import argparse
+import bz2
+import gzip
+import hashlib
+import heapq
+import http.client
+import io
 import re
+import socket
+import urllib.parse
 import os.path
 import csv
 import json
+import mmap
+import pickle
+import shutil
+import tempfile
+import itertools
+import struct
+import sys
 import time
+import tracemalloc
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import resource
+except ImportError:
+    resource = None
 
 # User inputs
 FILENAME_CSV = "categorylinkspage-join.csv"
+# The raw page and categorylinks SQL dumps are used instead of the .csv dump
+# if both are present
+FILENAME_PAGE_SQL = "enwiki-20190101-page.sql.gz"
+FILENAME_CATEGORYLINKS_SQL = "enwiki-20190101-categorylinks.sql.gz"
+# The page_props SQL dump, if present, flags the hidden categories
+FILENAME_PAGE_PROPS_SQL = "enwiki-20190101-page_props.sql.gz"
 FILENAME_ARTICLES_XML = "enwiki-20190101-pages-articles-multistream.xml"
-wantedCategory = "Computer_hardware"
-maxDepth = 10
+# (wantedCategory, maxDepth) jobs, all extracted in one pass over the dump.
+# A job may also be (name, selection expression) to extract the articles of
+# a combination of closures into output/<name>, e.g. ("Hardware_companies",
+# "Computer_hardware:5 & Companies:3 - Video_games:2"), see parse_selection
+jobs = [("Computer_hardware", 10)]
+# Closure pruning: categories whose name matches excludeCategories (a
+# regular expression searched in names with spaces, e.g.
+# r"^(Articles with |All stub articles|Wikipedia )"), hidden categories if
+# excludeHidden (needs the page_props dump) and categories with more than
+# maxCategoryMembers articles and subcategories are neither collected nor
+# descended into; the starting category itself is always kept
+excludeCategories = None
+excludeHidden = True
+maxCategoryMembers = None
+# Besides the binary <category>_selection-d<depth>.store of every job (see
+# Selection), save its category depths, category links and category article
+# ids as "csv" and/or "json" files
+exportFormats = []
+# Address of a running graph_server.py, e.g. "localhost:8765" or
+# "unix:/tmp/graph.sock": if it answers, the category graph is not loaded
+# and every job's categories are selected by the server, otherwise (or if
+# None) the graph is loaded here
+graphServer = None
+# Number of worker processes parsing the .csv dump
+ingestWorkers = 1
+# Memory budget in bytes for the category links read from the dumps, e.g.
+# 512 * 1024 * 1024, or None to hold them all in memory: beyond it they are
+# spilled to sorted runs in the resources folder and merged into the graph
+# at the end. The .sql dumps are then joined in page id order
+ingestMemoryBytes = None
+# Article text cleaner: "single" (one pass) or "regex" (one re.sub per
+# pattern of regexps_dict, slower)
+textCleaner = "single"
+# Number of files the articles of every job are spread over, balanced by
+# size, e.g. one per downstream WikiExtractor process or machine
+outputShards = 1
+# Number of worker processes scanning the article dump
+scanWorkers = 1
+# Compression of the extracted articles: "none", "gzip", "bz2" or "zstd"
+# (needs the zstandard package), its level and the number of threads
+# compressing independent blocks of the output
+outputCodec = "bz2"
+outputCompressLevel = 9
+compressThreads = 1
+# Disk budget for cached category closures
+closureCacheBytes = 256 * 1024 * 1024
+# Depth up to which closures are read from a reachability index saved next
+# to the category graph (built once per dump and pruning settings, slow on
+# a full dump), or None to search the graph
+reachIndexDepth = None
+# File in the output folder receiving the throughput and memory metrics of
+# every stage as JSON, e.g. "metrics.json", or None
+metricsFile = None
+# Report the lines allocating the most memory in every stage (tracemalloc,
+# slows the run down considerably)
+traceAllocations = False
+# WikiExtractor arguments, e.g. ["--json", "-b", "5G"]: if set, the selected
+# articles are extracted straight into plain text in each job's output
+# directory instead of being written to an intermediate XML file
+extractorArgs = None
 
 # Create paths
 RESOURCES_PATH = os.path.join(os.path.abspath(os.path.dirname(__file__)),
                               "resources")
-OUTPUT_PATH = os.path.join(os.path.abspath(os.path.dirname(__file__)),
-                           "output", wantedCategory.replace(" ", "_") +
-                           "-d" + str(maxDepth))
-
-if not os.path.isdir(OUTPUT_PATH):
-    try:
-        os.makedirs(OUTPUT_PATH)
-    except OSError:
-        print("Creating directories %s failed" % OUTPUT_PATH)
-    else:
-        print("Successfully created directories %s" % OUTPUT_PATH)
+OUTPUT_ROOT_PATH = os.path.join(os.path.abspath(os.path.dirname(__file__)),
+                                "output")
 
 # Set input file paths
 INPUT_FILEPATH_CSV_DUMP = os.path.join(RESOURCES_PATH, FILENAME_CSV)
+INPUT_FILEPATH_PAGE_SQL = os.path.join(RESOURCES_PATH, FILENAME_PAGE_SQL)
+INPUT_FILEPATH_CATEGORYLINKS_SQL = os.path.join(RESOURCES_PATH,
+                                                FILENAME_CATEGORYLINKS_SQL)
+INPUT_FILEPATH_PAGE_PROPS_SQL = os.path.join(RESOURCES_PATH,
+                                             FILENAME_PAGE_PROPS_SQL)
 INPUT_FILEPATH_ARTICLES_XML_BZ2 = os.path.join(RESOURCES_PATH,
                                                FILENAME_ARTICLES_XML)
 
 # Set filenames for processed .csv dump files
-FILENAME_CATEGORYLINKS_JSON = "categories_" + FILENAME_CSV.split(".")[0] + \
-                              ".json"
-FILENAME_ARTICLES_ID_CAT_CSV = "articles_" + FILENAME_CSV + ".csv"
+FILENAME_CATEGORY_GRAPH = "categories_" + FILENAME_CSV.split(".")[0] + \
+                          ".graph"
+FILENAME_CATEGORY_GRAPH_SQL = "categories_" + \
+                              FILENAME_CATEGORYLINKS_SQL.split(".")[0] + \
+                              ".graph"
+CLOSURE_CACHE_PATH = os.path.join(RESOURCES_PATH, "closures")
+WIKIEXTRACTOR_PATH = os.path.join(os.path.abspath(os.path.dirname(__file__)),
+                                  "wikiextractor")
 
 
 def printTime(start, end):
@@ -47,6 +146,128 @@ def printTime(start, end):
     print("Elapsed time: %sm %ss" % (minutes, seconds))
 
 
+# Stage instrumentation
+PROGRESS_INTERVAL = 30
+TOP_ALLOCATORS = 5
+stage_metrics = []
+
+
+def peak_rss(children=False):
+    # Peak resident set size in bytes, or None where unavailable
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN if children else
+                             resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+class Stage(object):
+    # Times a stage and reports its throughput, progress through its input
+    # and memory use; the results are collected in stage_metrics
+
+    def __init__(self, name, unit="rows", total=None):
+        self.name = name
+        self.unit = unit
+        self.total = total
+        self.rows = 0
+        self.file = None
+        self.size = None
+        self.read = 0
+
+    def __enter__(self):
+        if traceAllocations:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            self.snapshot = tracemalloc.take_snapshot()
+        self.start = self.last = time.time()
+        self.next_check = 1000
+        self.entry_peak_rss = peak_rss()
+        return self
+
+    def track(self, path, file):
+        # Follow the position of file, opened at path, as progress
+        self.untrack()
+        self.file = file
+        self.size = os.path.getsize(path)
+
+    def untrack(self):
+        if self.file is not None:
+            self.read += self.position()
+            self.file = None
+
+    def add_read(self, size):
+        # Bytes read from a file that is not followed
+        self.read += size
+
+    def position(self):
+        return self.size if self.file.closed else self.file.tell()
+
+    def add(self, n=1):
+        self.rows += n
+        if self.rows >= self.next_check:
+            self.next_check = self.rows + 1000
+            if time.time() - self.last >= PROGRESS_INTERVAL:
+                self.last = time.time()
+                self.progress()
+
+    def progress(self):
+        elapsed = self.last - self.start
+        line = "%s: %s %s (%d/s)" % (self.name, self.rows, self.unit,
+                                     self.rows / elapsed)
+        done = None
+        if self.file is not None:
+            position = self.position()
+            line += ", %.1f MB read" % ((self.read + position) / 2 ** 20)
+            done = position / self.size if self.size else None
+        elif self.total:
+            done = self.rows / self.total
+        if done:
+            remaining = elapsed / done - elapsed
+            line += ", %d%%, ETA %dm %ds" % (100 * done, remaining // 60,
+                                             remaining % 60)
+        print(line)
+
+    def __exit__(self, *exc):
+        end = time.time()
+        self.untrack()
+        seconds = end - self.start
+        rate = self.rows / seconds if seconds else 0
+        metrics = {"stage": self.name, "unit": self.unit, "rows": self.rows,
+                   "seconds": round(seconds, 3),
+                   "rows_per_second": round(rate, 1),
+                   "bytes_read": self.read or None,
+                   "peak_rss": peak_rss(),
+                   "peak_rss_children": peak_rss(children=True)}
+        # The peak is the process's so far: the stage's own memory shows as
+        # how much it raised the peak
+        metrics["peak_rss_increase"] = (
+            metrics["peak_rss"] - self.entry_peak_rss
+            if metrics["peak_rss"] is not None else None)
+        line = "%s: %s %s (%d/s)" % (self.name, self.rows, self.unit, rate)
+        if self.read:
+            line += ", %.1f MB read" % (self.read / 2 ** 20)
+        if metrics["peak_rss"]:
+            line += ", peak RSS %.1f MB" % (metrics["peak_rss"] / 2 ** 20)
+        print(line)
+        if traceAllocations:
+            metrics["peak_traced"] = tracemalloc.get_traced_memory()[1]
+            metrics["top_allocators"] = []
+            snapshot = tracemalloc.take_snapshot().filter_traces(
+                [tracemalloc.Filter(False, tracemalloc.__file__)])
+            for stat in snapshot.compare_to(
+                    self.snapshot, "lineno")[:TOP_ALLOCATORS]:
+                metrics["top_allocators"].append(
+                    {"line": str(stat.traceback), "size": stat.size_diff,
+                     "count": stat.count_diff})
+                print("  %s: %+.1f MB in %+d blocks" % (
+                    stat.traceback, stat.size_diff / 2 ** 20,
+                    stat.count_diff))
+            self.snapshot = None
+        printTime(self.start, end)
+        stage_metrics.append(metrics)
+
+
 regexps_dict = {
     '\[\[+(Category:)(.*?)\]+\]|\[\[(?:[^\]|]*\|)?([^\]|]*)\]\]': r'\3',
     '\[\[+(File:)(.*?)\]+\]': "",
@@ -67,6 +288,53 @@ def clean_text(text, regexps_dict):
     return text.encode('ascii', 'ignore')
 
 
+# The link patterns of regexps_dict as a single compiled alternation, tried
+# in the order they are applied. Category: links and links inside a File:
+# link are matched whole (atomically, through a lookahead and a
+# backreference) as regexps_dict removes them before it removes the File:
+# link, and the "]" of its end may be split by removed ones. Entities are
+# removed afterwards, as they may only be completed by the removal of a link
+CLEAN_CATEGORY = r"\[\[+Category:.*?\]+\]"
+CLEAN_LINK = r"\[\[(?:[^\]|]*\|)?([^\]|]*)\]\]"
+CLEAN_INNER = r"%s|\[\[(?:[^\]|]*\|)?[^\]|\n]*\]\]" % CLEAN_CATEGORY
+CLEAN_REMOVED = r"%s|\[\[(?:[^\]|]*\|)?\]\]" % CLEAN_CATEGORY
+CLEAN_FILE = (r"\[\[+File:(?:(?=(?P<inner>%s))(?P=inner)|(?!%s).)*?"
+              r"\](?:(?:(?=(?P<removed>%s))(?P=removed))*\])+"
+              % (CLEAN_INNER, CLEAN_INNER, CLEAN_REMOVED))
+clean_re = re.compile("|".join((CLEAN_CATEGORY, CLEAN_LINK, CLEAN_FILE)))
+clean_entity_re = re.compile(r"&(?:amp;)?#[a-zA-Z0-9]*;")
+
+
+class RescanNeeded(Exception):
+    pass
+
+
+def clean_match(m):
+    # Keep the text of links. Link text with a "[" may start a File: link
+    # regexps_dict removes in its next pass: such (malformed) pages are left
+    # to the regex cleaner
+    text = m.group(1)
+    if not text:
+        return ""
+    if "[" in text:
+        raise RescanNeeded()
+    return text
+
+
+def clean_text_single(text):
+    try:
+        text = clean_re.sub(clean_match, text)
+    except RescanNeeded:
+        return clean_text(text, regexps_dict)
+    if "&" in text:
+        text = clean_entity_re.sub("", text)
+    return text.encode('ascii', 'ignore')
+
+
+TEXT_CLEANERS = {"regex": partial(clean_text, regexps_dict=regexps_dict),
+                 "single": clean_text_single}
+
+
 def save_as_csv(dict, filepath):
     with open(filepath, "w", encoding="latin-1") as csv_file:
         csvwriter = csv.writer(csv_file, delimiter=",", lineterminator="\n",
@@ -84,117 +352,1453 @@ def save_as_json(dict, filepath):
         print("%s saved." % filepath)
 
 
-def csvdump_extractor(inputfile_csv, outputfile_articles_csv):
+# Stage manifests: every stage output is saved with a <output>.manifest
+# recording the inputs and parameters it was built from; it is written last,
+# so an output is only reused if its stage completed with the same inputs
+def file_fingerprint(path):
+    stat = os.stat(path)
+    return {"path": path, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def stage_manifest(inputs, **params):
+    # Round trip through JSON to compare equal to a loaded manifest
+    return json.loads(json.dumps({"inputs": inputs, "params": params}))
+
+
+def load_manifest(path):
+    try:
+        with open(path + ".manifest", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def current_manifest(path, manifest):
+    # The saved manifest of the stage output at path, or None if the output
+    # is missing or was built from other inputs or parameters
+    saved = load_manifest(path)
+    if saved is None or not os.path.exists(path) or \
+            saved["inputs"] != manifest["inputs"] or \
+            saved["params"] != manifest["params"]:
+        return None
+    return saved
+
+
+def save_manifest(path, manifest, **results):
+    with open(path + ".manifest.tmp", "w", encoding="utf-8") as f:
+        json.dump(dict(manifest, results=results), f)
+    os.replace(path + ".manifest.tmp", path + ".manifest")
+
+
+# Binary store: a JSON header naming typed arrays, followed by the 8-byte
+# aligned array data, memory-mapped when opened
+STORE_MAGIC = b"DPSTORE1"
+STORE_ALIGN = 8
+COPY_CHUNK_SIZE = 64 * 1024
+
+
+def padding(size):
+    return -size % STORE_ALIGN
+
+
+def save_store(path, arrays, meta=None):
+    header = {"meta": meta or {}, "arrays": {}}
+    offset = 0
+    for name, a in arrays.items():
+        header["arrays"][name] = [a.typecode, offset, len(a)]
+        size = len(a) * a.itemsize
+        offset += size + padding(size)
+    raw = json.dumps(header).encode("utf-8")
+    raw += b" " * padding(len(STORE_MAGIC) + 8 + len(raw))
+    with open(path + ".tmp", "wb") as f:
+        f.write(STORE_MAGIC)
+        f.write(struct.pack("<q", len(raw)))
+        f.write(raw)
+        for a in arrays.values():
+            a.tofile(f)
+            f.write(bytes(padding(len(a) * a.itemsize)))
+    os.replace(path + ".tmp", path)
+    print("%s saved." % path)
+
+
+class ArrayFile(object):
+    # Array written to a file in parts, for arrays too large for memory;
+    # save_store accepts it in place of an array once closed
+
+    def __init__(self, path, typecode):
+        self.path = path
+        self.typecode = typecode
+        self.itemsize = array(typecode).itemsize
+        self.file = open(path, "wb")
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def extend(self, items):
+        if not isinstance(items, (array, bytes)):
+            items = array(self.typecode, items)
+        self.file.write(items)
+        self.length += len(items)
+
+    def close(self):
+        self.file.close()
+
+    def chunks(self):
+        with open(self.path, "rb") as f:
+            yield from iter(partial(f.read, COPY_CHUNK_SIZE), b"")
+
+    def tofile(self, f):
+        for chunk in self.chunks():
+            f.write(chunk)
+
+
+class Store(object):
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            if f.read(len(STORE_MAGIC)) != STORE_MAGIC:
+                raise ValueError("Not a binary store: %s" % path)
+            length, = struct.unpack("<q", f.read(8))
+            header = json.loads(f.read(length).decode("utf-8"))
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.path = path
+        self.meta = header["meta"]
+        self._arrays = header["arrays"]
+        self._start = len(STORE_MAGIC) + 8 + length
+
+    def __contains__(self, name):
+        return name in self._arrays
+
+    def array(self, name):
+        typecode, offset, length = self._arrays[name]
+        start = self._start + offset
+        size = length * array(typecode).itemsize
+        return memoryview(self._data)[start:start + size].cast(typecode)
+
+
+def string_arrays(strings):
+    # Concatenated utf-8 strings and their start offsets (plus the end)
+    encoded = [string.encode("utf-8") for string in strings]
+    offsets = array("q", [0])
+    for e in encoded:
+        offsets.append(offsets[-1] + len(e))
+    return array("B", b"".join(encoded)), offsets
+
+
+class StringTable(object):
+    # Read-only view of strings saved with string_arrays, sorted for lookup
+
+    def __init__(self, store, name):
+        self._data = store.array(name)
+        self._offsets = store.array(name + "_offsets")
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        return str(self._data[self._offsets[i]:self._offsets[i + 1]],
+                   "utf-8")
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def find(self, string):
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self[mid] < string:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self[lo] == string:
+            return lo
+        return -1
+
+
+def csr_arrays(keys, values, n, typecode):
+    # Group values by key (stable) into offsets and flat values arrays
+    offsets = array("q", bytes(8 * (n + 1)))
+    for k in keys:
+        offsets[k + 1] += 1
+    for i in range(n):
+        offsets[i + 1] += offsets[i]
+    pos = array("q", offsets)
+    flat = array(typecode, bytes(array(typecode).itemsize * len(values)))
+    for k, v in zip(keys, values):
+        flat[pos[k]] = v
+        pos[k] += 1
+    return offsets, flat
+
+
+class PageIdSet(object):
+    # Bitmap of page ids: page ids are dense integers below a few hundred
+    # million, so one bit per possible id is far smaller than a set of ints
+    # and pickles into a single buffer for the scan workers
+
+    def __init__(self, ids=()):
+        self.bits = bytearray()
+        self.update(ids)
+
+    def add(self, page_id):
+        i = page_id >> 3
+        if i >= len(self.bits):
+            self.bits.extend(bytes(i - len(self.bits) + 1 + (1 << 20)))
+        self.bits[i] |= 1 << (page_id & 7)
+
+    def update(self, ids):
+        for page_id in ids:
+            self.add(page_id)
+
+    def discard(self, page_id):
+        i = page_id >> 3
+        if i < len(self.bits):
+            self.bits[i] &= ~(1 << (page_id & 7))
+
+    def difference_update(self, ids):
+        for page_id in ids:
+            self.discard(page_id)
+
+    def __ior__(self, other):
+        self.bits = (self | other).bits
+        return self
+
+    # Set algebra on the bitmaps as (arbitrarily large) integers
+    def __or__(self, other):
+        return self.combine(int(self) | int(other),
+                            max(len(self.bits), len(other.bits)))
+
+    def __and__(self, other):
+        return self.combine(int(self) & int(other),
+                            min(len(self.bits), len(other.bits)))
+
+    def __sub__(self, other):
+        return self.combine(int(self) & ~int(other), len(self.bits))
+
+    def __int__(self):
+        return int.from_bytes(self.bits, "little")
+
+    def combine(self, bits, n):
+        result = PageIdSet()
+        result.bits = bytearray(bits.to_bytes(n, "little"))
+        return result
+
+    def __contains__(self, page_id):
+        i = page_id >> 3
+        return i < len(self.bits) and self.bits[i] >> (page_id & 7) & 1 == 1
+
+    def __len__(self):
+        return int(self).bit_count()
+
+    def __iter__(self):
+        # Ascending page ids
+        for i, byte in enumerate(self.bits):
+            while byte:
+                low = byte & -byte
+                yield i << 3 | low.bit_length() - 1
+                byte ^= low
+
+    def digest(self):
+        return hashlib.blake2b(self.bits.rstrip(b"\0"),
+                               digest_size=16).hexdigest()
+
+
+def page_id_set(ids):
+    if isinstance(ids, PageIdSet):
+        return ids
+    return PageIdSet(int(id) for id in ids)
+
+
+# Category flags
+FLAG_HIDDEN = 1
+
+
+class GraphBuilder(object):
+    # Interns category names while the category links are read
+
+    def __init__(self):
+        self.ids = {}
+        self.parents = array("i")
+        self.children = array("i")
+        self.member_cats = array("i")
+        self.member_pages = array("i")
+        self.member_lens = array("i")
+        self.hidden = set()
+
+    def intern(self, name):
+        id = self.ids.get(name)
+        if id is None:
+            id = self.ids[name] = len(self.ids)
+        return id
+
+    def add_subcat(self, cat, subcat):
+        self.parents.append(self.intern(cat))
+        self.children.append(self.intern(subcat))
+
+    def add_page(self, cat, page_id, length=0):
+        # length: the page_len of the article
+        self.member_cats.append(self.intern(cat))
+        self.member_pages.append(page_id)
+        self.member_lens.append(length)
+
+    def hide(self, cat):
+        self.hidden.add(self.intern(cat))
+
+    def merge(self, other):
+        # Append the links read into another builder, e.g. by a worker
+        ids = array("i", map(self.intern, other.ids))
+        self.parents.extend(array("i", map(ids.__getitem__, other.parents)))
+        self.children.extend(array("i", map(ids.__getitem__,
+                                            other.children)))
+        self.member_cats.extend(array("i", map(ids.__getitem__,
+                                               other.member_cats)))
+        self.member_pages.extend(other.member_pages)
+        self.member_lens.extend(other.member_lens)
+        self.hidden.update(map(ids.__getitem__, other.hidden))
+
+    def save(self, path):
+        # Renumber categories in name order so that ids can be binary searched
+        names = list(self.ids)
+        order = sorted(range(len(names)), key=names.__getitem__)
+        rank = array("i", bytes(4 * len(names)))
+        for new, old in enumerate(order):
+            rank[old] = new
+        names = [names[old] for old in order]
+        parents = array("i", (rank[p] for p in self.parents))
+        children = array("i", (rank[c] for c in self.children))
+        offsets, subcats = csr_arrays(parents, children, len(names), "i")
+        member_ranks = array("i", (rank[c] for c in self.member_cats))
+        member_offsets, members = csr_arrays(
+            member_ranks, self.member_pages, len(names), "i")
+        member_offsets, member_lens = csr_arrays(
+            member_ranks, self.member_lens, len(names), "i")
+        member_ranks = None
+        for i in range(len(names)):
+            a, b = member_offsets[i], member_offsets[i + 1]
+            if b - a > 1:
+                order = sorted(range(a, b), key=members.__getitem__)
+                members[a:b] = array("i", map(members.__getitem__, order))
+                member_lens[a:b] = array("i", map(member_lens.__getitem__,
+                                                  order))
+        flags = array("B", bytes(len(names)))
+        for old in self.hidden:
+            flags[rank[old]] |= FLAG_HIDDEN
+        data, name_offsets = string_arrays(names)
+        save_graph(path, {"names": data, "names_offsets": name_offsets,
+                          "subcat_offsets": offsets, "subcats": subcats,
+                          "member_offsets": member_offsets,
+                          "members": members, "member_lens": member_lens,
+                          "flags": flags})
+
+
+def save_graph(path, arrays):
+    fingerprint = hashlib.blake2b(digest_size=8)
+    for a in arrays.values():
+        for chunk in (a.chunks() if isinstance(a, ArrayFile) else [a]):
+            fingerprint.update(chunk)
+    save_store(path, arrays, {"fingerprint": fingerprint.hexdigest()})
+
+
+# External-memory graph building: links are buffered up to the memory
+# budget, then sorted and spilled to run files of pickled batches, which
+# save() merges into the same graph store as GraphBuilder's
+RECORD_OVERHEAD = 200
+RUN_BATCH_SIZE = 10000
+# Runs merged at once, each holding one batch of records in memory; batches
+# are made smaller to fit the budget, down to RUN_MIN_BATCH_SIZE records
+MERGE_FAN_IN = 8
+RUN_MIN_BATCH_SIZE = 100
+
+
+def write_run(path, records, size=RUN_BATCH_SIZE):
+    # records: a sorted list or iterator, pickled in batches of size
+    with open(path, "wb") as f:
+        for batch in batches(records, size):
+            pickle.dump(batch, f, pickle.HIGHEST_PROTOCOL)
+
+
+def read_run(path):
+    with open(path, "rb") as f:
+        while True:
+            try:
+                batch = pickle.load(f)
+            except EOFError:
+                return
+            yield from batch
+
+
+def batches(items, size):
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+def unique(items):
+    # Sorted items without repeats
+    last = None
+    for item in items:
+        if item != last:
+            yield item
+            last = item
+
+
+class ExternalGraphBuilder(object):
+    # GraphBuilder holding about budget bytes of links at most: links are
+    # kept by category name, the order of the subcategories of a category
+    # by a sequence number
+
+    def __init__(self, path, budget):
+        self.path = tempfile.mkdtemp(prefix="runs-", dir=path)
+        self.budget = budget
+        self.subcats = []
+        self.members = []
+        self.hidden = set()
+        self.size = 0
+        self.seq = 0
+        self.runs = 0
+        # Records per batch of a run: a batch per merged run, unpickled next
+        # to its pickle, fits the budget
+        self.batch = int(max(RUN_MIN_BATCH_SIZE, min(
+            RUN_BATCH_SIZE,
+            budget // (2 * MERGE_FAN_IN * RECORD_OVERHEAD))))
+
+    def add_subcat(self, cat, subcat):
+        self.subcats.append((cat, self.seq, subcat))
+        self.seq += 1
+        self.grow(len(cat) + len(subcat))
+
+    def add_page(self, cat, page_id, length=0):
+        self.members.append((cat, page_id, length))
+        self.grow(len(cat))
+
+    def hide(self, cat):
+        self.hidden.add(cat)
+
+    def merge(self, other):
+        # Append the links read into a GraphBuilder, e.g. by a worker
+        names = list(other.ids)
+        for p, c in zip(other.parents, other.children):
+            self.add_subcat(names[p], names[c])
+        for c, page_id, length in zip(other.member_cats, other.member_pages,
+                                      other.member_lens):
+            self.add_page(names[c], page_id, length)
+        self.hidden.update(names[c] for c in other.hidden)
+
+    def grow(self, size):
+        self.size += size + RECORD_OVERHEAD
+        if self.size >= self.budget:
+            self.spill()
+
+    def run_path(self, kind, run):
+        return os.path.join(self.path, "%s-%s.run" % (kind, run))
+
+    def spill(self):
+        self.subcats.sort()
+        self.members.sort()
+        names = set(cat for cat, seq, subcat in self.subcats)
+        names.update(subcat for cat, seq, subcat in self.subcats)
+        names.update(cat for cat, page_id, length in self.members)
+        write_run(self.run_path("names", self.runs), sorted(names),
+                  self.batch)
+        names.clear()
+        write_run(self.run_path("subcats", self.runs), self.subcats,
+                  self.batch)
+        write_run(self.run_path("members", self.runs), self.members,
+                  self.batch)
+        self.subcats = []
+        self.members = []
+        self.size = 0
+        self.runs += 1
+
+    def merged(self, kind):
+        # The records of all runs of kind in order. Runs are merged
+        # MERGE_FAN_IN at a time into longer runs until that many are left,
+        # so that no more batches than that are held at once
+        paths = [self.run_path(kind, run) for run in range(self.runs)]
+        rounds = 0
+        while len(paths) > MERGE_FAN_IN:
+            merged = []
+            for i in range(0, len(paths), MERGE_FAN_IN):
+                group = paths[i:i + MERGE_FAN_IN]
+                path = os.path.join(self.path, "%s-%s-%s.run" % (
+                    kind, rounds, i // MERGE_FAN_IN))
+                write_run(path, heapq.merge(*map(read_run, group)),
+                          self.batch)
+                for run_path in group:
+                    os.remove(run_path)
+                merged.append(path)
+            paths = merged
+            rounds += 1
+        return heapq.merge(*map(read_run, paths))
+
+    def save(self, path):
+        self.spill()
+        try:
+            with Stage("Run merge", "links") as stage:
+                self.save_runs(path, stage)
+        finally:
+            shutil.rmtree(self.path)
+
+    def save_runs(self, path, stage):
+        # Category names in order, then the links of every category in name
+        # order: parents by walking along the names, subcategories by
+        # binary search in the names saved first
+        names = heapq.merge(self.merged("names"), sorted(self.hidden))
+        data = ArrayFile(os.path.join(self.path, "names"), "B")
+        name_offsets = ArrayFile(os.path.join(self.path, "names_offsets"), "q")
+        flags = ArrayFile(os.path.join(self.path, "flags"), "B")
+        offset = 0
+        name_offsets.extend([0])
+        for batch in batches(unique(names), self.batch):
+            encoded = [name.encode("utf-8") for name in batch]
+            offsets = array("q")
+            for e in encoded:
+                offset += len(e)
+                offsets.append(offset)
+            data.extend(b"".join(encoded))
+            name_offsets.extend(offsets)
+            flags.extend([FLAG_HIDDEN if name in self.hidden else 0
+                          for name in batch])
+        for a in (data, name_offsets, flags):
+            a.close()
+        lookup_path = os.path.join(self.path, "names.store")
+        save_store(lookup_path, {"names": data,
+                                 "names_offsets": name_offsets})
+        table = StringTable(Store(lookup_path), "names")
+
+        def csr(kind, fields):
+            # fields: (array name, value of a record) of the values arrays
+            offsets = ArrayFile(os.path.join(self.path, kind + "_offsets"),
+                                "q")
+            values = [ArrayFile(os.path.join(self.path, field), "i")
+                      for field, value in fields]
+            batches = [array("i") for field in fields]
+            id = 0
+            name = table[id] if len(table) else None
+            count = 0
+            starts = array("q", [0])
+            for record in self.merged(kind):
+                while name != record[0]:
+                    id += 1
+                    name = table[id]
+                    starts.append(count)
+                for batch, (field, value) in zip(batches, fields):
+                    batch.append(value(record))
+                count += 1
+                if len(starts) + len(batches[0]) >= self.batch:
+                    stage.add(len(batches[0]))
+                    for a, batch in zip(values, batches):
+                        a.extend(batch)
+                        del batch[:]
+                    offsets.extend(starts)
+                    del starts[:]
+            stage.add(len(batches[0]))
+            for a, batch in zip(values, batches):
+                a.extend(batch)
+            offsets.extend(starts)
+            offsets.extend(array("q", [count]) * (len(table) - id))
+            offsets.close()
+            for a in values:
+                a.close()
+            return [offsets] + values
+
+        subcat_offsets, subcats = csr(
+            "subcats", [("subcats", lambda record: table.find(record[2]))])
+        member_offsets, members, member_lens = csr(
+            "members", [("members", lambda record: record[1]),
+                        ("member_lens", lambda record: record[2])])
+        save_graph(path, {"names": data, "names_offsets": name_offsets,
+                          "subcat_offsets": subcat_offsets,
+                          "subcats": subcats,
+                          "member_offsets": member_offsets,
+                          "members": members, "member_lens": member_lens,
+                          "flags": flags})
+
+
+def graph_builder(budget=None):
+    # Builder of the category graph holding all links in memory, or about
+    # budget bytes of them at most
+    if budget is None:
+        return GraphBuilder()
+    return ExternalGraphBuilder(RESOURCES_PATH, budget)
+
+
+class CategoryGraph(object):
+    # Category graph saved by GraphBuilder: the subcategories of category i
+    # are subcats[subcat_offsets[i]:subcat_offsets[i + 1]] and its articles
+    # the sorted page ids members[member_offsets[i]:member_offsets[i + 1]],
+    # whose page_len are at the same positions of member_lens; flags[i]
+    # holds its FLAG_* bits
+
+    def __init__(self, path):
+        self.store = Store(path)
+        self.names = StringTable(self.store, "names")
+        self.subcat_offsets = self.store.array("subcat_offsets")
+        self.subcat_ids = self.store.array("subcats")
+        self.member_offsets = self.store.array("member_offsets")
+        self.member_ids = self.store.array("members")
+        self.flags = self.store.array("flags") \
+            if "flags" in self.store else None
+        # page_len of every member, in graphs saved since it is read
+        self.member_lens = self.store.array("member_lens") \
+            if "member_lens" in self.store else None
+        self.fingerprint = self.store.meta.get("fingerprint")
+        if self.fingerprint is None:
+            stat = os.stat(path)
+            self.fingerprint = "%x-%x" % (stat.st_size, stat.st_mtime_ns)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return self.names.find(name) != -1
+
+    def id(self, name):
+        return self.names.find(name)
+
+    def name(self, id):
+        return self.names[id]
+
+    def subcats(self, id):
+        return self.subcat_ids[self.subcat_offsets[id]:
+                               self.subcat_offsets[id + 1]]
+
+    def members(self, id):
+        return self.member_ids[self.member_offsets[id]:
+                               self.member_offsets[id + 1]]
+
+
+# The .csv dump is cut into chunks at record boundaries: a record starts
+# with the unquoted page_id and page_namespace after a newline that is not
+# escaped by the escapechar
+CSV_CHUNK_SIZE = 64 * 1024 * 1024
+CSV_BOUNDARY_WINDOW = 1024 * 1024
+# With a memory budget: the share of it for the chunks being read or parsed
+# (the rest goes to the graph builder), the bytes of memory a chunk takes
+# per byte of the dump while parsed (the chunk, its lines and the builder of
+# a worker) and the smallest chunk size
+CSV_CHUNK_BUDGET_SHARE = 0.25
+CSV_CHUNK_COPIES = 4
+CSV_MIN_CHUNK_SIZE = 256 * 1024
+
+
+def csv_record_start(delimiter):
+    delimiter = re.escape(delimiter.encode("latin-1"))
+    return re.compile(rb'(?<=\n)"?\d+"?' + delimiter + rb'"?\d+"?' +
+                      delimiter)
+
+
+def csv_boundary(data, start, record_start):
+    # Offset of the first record starting at or after start, or -1
+    for m in record_start.finditer(data, start):
+        newline = m.start() - 1
+        i = newline
+        while i > 0 and data[i - 1:i] == b"\\":
+            i -= 1
+        if (newline - i) % 2 == 0:
+            return m.start()
+    return -1
+
+
+def csv_chunking(budget, workers):
+    # Chunk size and number of chunks queued for the workers (two per worker
+    # without a budget), so that the chunks held at once take about budget
+    # bytes at most
+    in_flight = 2 * workers if workers > 1 else 0
+    if budget is None:
+        return CSV_CHUNK_SIZE, in_flight
+    size = int(budget // (CSV_CHUNK_COPIES * (in_flight + 1)))
+    if size < CSV_MIN_CHUNK_SIZE:
+        size = CSV_MIN_CHUNK_SIZE
+        if workers > 1:
+            in_flight = max(1, int(budget // (CSV_CHUNK_COPIES * size)) - 1)
+    return min(size, CSV_CHUNK_SIZE), in_flight
+
+
+def csv_chunks(f, record_start, size=CSV_CHUNK_SIZE):
+    # Cut the file into chunks of about size bytes of whole records
+    rest = b""
+    while True:
+        block = f.read(size)
+        if not block:
+            if rest:
+                yield rest
+            return
+        data = rest + block
+        del block
+        cut = csv_boundary(data, max(1, len(data) - CSV_BOUNDARY_WINDOW),
+                           record_start)
+        if cut == -1:
+            cut = csv_boundary(data, 1, record_start)
+        if cut == -1:
+            rest = data
+        else:
+            chunk, rest = data[:cut], data[cut:]
+            del data
+            yield chunk
+            del chunk
+
+
+def csv_lines(data):
+    # The lines of a chunk, split at "\n" only: str.splitlines() would also
+    # split at characters such as \x85 inside the fields
+    lines = data.decode("latin-1").split("\n")
+    last = lines.pop()
+    for line in lines:
+        yield line + "\n"
+    if last:
+        yield last
+
+
+def read_csv_chunk(data, graph, format, hidden=None):
+    # Add the rows of a chunk of the .csv dump to graph; hidden: page ids of
+    # the hidden categories
+    rows = 0
+    for line in csv.reader(csv_lines(data), **format):
+        rows += 1
+        try:
+            # page_id = 0, page_namespace = 1, page_title = 2, page_len = 11,
+            # cl_to = 15
+            cat = normalize(line[15])
+            if line[1] == "14":
+                subcat = normalize(line[2])
+                graph.add_subcat(cat, subcat)
+                if hidden is not None and int(line[0]) in hidden:
+                    graph.hide(subcat)
+            if line[1] == "0":
+                graph.add_page(cat, int(line[0]), int(line[11]))
+        except IOError as e:
+            print("Skipped line: %s" % line)
+            continue
+    return rows
+
+
+ingest_format = None
+ingest_hidden = None
+
+
+def init_ingest(format, hidden):
+    global ingest_format, ingest_hidden
+    ingest_format = format
+    ingest_hidden = hidden
+
+
+def csv_part(data):
+    # Worker: read one chunk into a graph builder of its own
+    graph = GraphBuilder()
+    rows = read_csv_chunk(data, graph, ingest_format, ingest_hidden)
+    return graph, rows
+
+
+def csvdump_extractor(inputfile_csv, hidden=None, workers=1, budget=None):
+    # hidden: page ids of the hidden categories. The dump may be gzip or
+    # bz2 compressed; with workers > 1 its chunks are parsed in a process
+    # pool and merged in file order. budget: see graph_builder
     print(
         "Extracting all categories and articles from %s\n..." % inputfile_csv)
-    start = time.time()
     try:
-        with open(inputfile_csv, "r", encoding="latin-1") as csv_file, open(
-                outputfile_articles_csv, "w",
-                encoding="utf-8") as new_csv_file:
-            dialect = csv.Sniffer().sniff(csv_file.read(1024))
-            dialect.escapechar = "\\"
-            dialect.quoting = csv.QUOTE_MINIMAL
-            csv_file.seek(0)
-            reader = csv.reader(csv_file, dialect)
-            category_to_subcategory = defaultdict(list)
-            csvwriter = csv.writer(new_csv_file, delimiter=",", escapechar=" ",
-                                   lineterminator="\n",
-                                   quoting=csv.QUOTE_ALL)
-            for line in reader:
-                try:
-                    # page_id = 0, page_namespace = 1, page_title = 2, cl_to = 15
-                    cat = normalize(line[15])
-                    if line[1] == "14":
-                        subcat = normalize(line[2])
-                        category_to_subcategory[cat].append(subcat)
-                        category_to_subcategory[subcat]
-                    if line[1] == "0":
-                        csvwriter.writerow(
-                            [line[0], line[2].replace("\\", "\\\\"), cat])
-                except IOError as e:
-                    print("Skipped line: %s" % line)
-                    continue
-            end = time.time()
-            printTime(start, end)
-            print("%s saved." % outputfile_articles_csv)
-            return category_to_subcategory
+        with open(inputfile_csv, "rb") as raw, \
+                open_dump(inputfile_csv, raw) as f, \
+                Stage("CSV ingest") as stage:
+            dialect = csv.Sniffer().sniff(f.read(1024).decode("latin-1"))
+            f.seek(0)
+            format = {"delimiter": dialect.delimiter,
+                      "quotechar": dialect.quotechar,
+                      "doublequote": dialect.doublequote,
+                      "skipinitialspace": dialect.skipinitialspace,
+                      "escapechar": "\\", "quoting": csv.QUOTE_MINIMAL}
+            stage.track(inputfile_csv, raw)
+            if budget is not None:
+                chunk_budget = int(budget * CSV_CHUNK_BUDGET_SHARE)
+                budget -= chunk_budget
+            else:
+                chunk_budget = None
+            size, in_flight = csv_chunking(chunk_budget, workers)
+            chunks = csv_chunks(f, csv_record_start(dialect.delimiter), size)
+            graph = graph_builder(budget)
+            if workers <= 1:
+                for data in chunks:
+                    stage.add(read_csv_chunk(data, graph, format, hidden))
+                return graph
+            with Pool(workers, initializer=init_ingest,
+                      initargs=(format, hidden)) as pool:
+                # Keep a bounded number of chunks in flight
+                pending = deque()
+                for data in chunks:
+                    pending.append(pool.apply_async(csv_part, (data,)))
+                    while len(pending) > in_flight:
+                        part, rows = pending.popleft().get()
+                        graph.merge(part)
+                        stage.add(rows)
+                while pending:
+                    part, rows = pending.popleft().get()
+                    graph.merge(part)
+                    stage.add(rows)
+        return graph
     except FileNotFoundError as e:
         print("Inputfile not found:", inputfile_csv)
         raise e
 
 
-def getcategorydepths(cat_to_subcats, wantedcategory, maxdepth):
+def open_dump(path, file=None):
+    # file: the dump file at path if already opened, e.g. to follow its
+    # position
+    if path.endswith(".gz"):
+        return gzip.open(file or path, "rb")
+    if path.endswith(".bz2"):
+        return BZ2File(file or path, "r")
+    return file or open(path, "rb")
+
+
+# mysqldump output: column definitions in CREATE TABLE, then rows in long
+# "INSERT INTO `table` VALUES (...),(...);" lines
+SQL_INSERT = b"INSERT INTO "
+SQL_VALUES = b" VALUES "
+sql_token_re = re.compile(rb"'((?:[^'\\]|\\.)*)'|([^,()']+)|(\))", re.S)
+sql_escape_re = re.compile(rb"\\(.)", re.S)
+SQL_ESCAPES = {b"0": b"\0", b"n": b"\n", b"r": b"\r", b"t": b"\t",
+               b"Z": b"\x1a"}
+
+
+def sql_unescape(value):
+    if b"\\" not in value:
+        return value
+    return sql_escape_re.sub(
+        lambda m: SQL_ESCAPES.get(m.group(1), m.group(1)), value)
+
+
+def sql_rows(line):
+    row = []
+    for m in sql_token_re.finditer(line, line.index(SQL_VALUES) +
+                                   len(SQL_VALUES)):
+        string, value, close = m.groups()
+        if close:
+            yield row
+            row = []
+        elif string is not None:
+            row.append(sql_unescape(string))
+        else:
+            row.append(value)
+
+
+def sql_dump_rows(path, columns, stage):
+    # Yield the values (as bytes) of the given columns for every row of a
+    # mysqldump file
+    with open(path, "rb") as raw, open_dump(path, raw) as f:
+        stage.track(path, raw)
+        names = []
+        for line in f:
+            if line.startswith(b"  `"):
+                names.append(line.split(b"`")[1].decode("utf-8"))
+            elif line.startswith(SQL_INSERT):
+                break
+        index = [names.index(column) for column in columns]
+        for line in itertools.chain([line], f):
+            if line.startswith(SQL_INSERT):
+                for row in sql_rows(line):
+                    stage.add()
+                    yield [row[i] for i in index]
+
+
+def hidden_category_ids(inputfile_page_props_sql):
+    # Page ids of the categories flagged __HIDDENCAT__
+    hidden = PageIdSet()
+    try:
+        with Stage("SQL page_props ingest") as stage:
+            for page_id, name in sql_dump_rows(inputfile_page_props_sql,
+                                               ("pp_page", "pp_propname"),
+                                               stage):
+                if name == b"hiddencat":
+                    hidden.add(int(page_id))
+    except FileNotFoundError as e:
+        print("Inputfile not found:", e.filename)
+        raise e
+    print("%s hidden categories read from %s" % (
+        len(hidden), inputfile_page_props_sql))
+    return hidden
+
+
+def sorted_pages(rows, graph, hidden):
+    # Page rows with the titles of categories, checked to be in page id
+    # order; hidden categories are flagged in graph
+    last = -1
+    for page_id, namespace, title, length in rows:
+        page_id = int(page_id)
+        if page_id <= last:
+            raise ValueError("The page dump is not sorted by page_id")
+        last = page_id
+        if namespace == b"14":
+            title = normalize(title.decode("utf-8", "replace"))
+            if hidden is not None and page_id in hidden:
+                graph.hide(title)
+        yield page_id, namespace, title, length
+
+
+def sqldump_merge_join(inputfile_page_sql, inputfile_categorylinks_sql,
+                       hidden, budget):
+    # Merge join of the dumps, both in page id order (their primary key
+    # order, in which mysqldump writes them), holding a single page row
+    graph = ExternalGraphBuilder(RESOURCES_PATH, budget)
+    with Stage("SQL page join") as page_stage, \
+            Stage("SQL categorylinks join") as stage:
+        pages = sorted_pages(sql_dump_rows(
+            inputfile_page_sql,
+            ("page_id", "page_namespace", "page_title", "page_len"),
+            page_stage), graph, hidden)
+        page_id, namespace, title, length = -1, None, None, None
+        last = -1
+        for cl_from, cl_to in sql_dump_rows(inputfile_categorylinks_sql,
+                                            ("cl_from", "cl_to"), stage):
+            cl_from = int(cl_from)
+            if cl_from < last:
+                raise ValueError("The categorylinks dump is not sorted by "
+                                 "cl_from")
+            last = cl_from
+            while page_id < cl_from:
+                page_id, namespace, title, length = next(
+                    pages, (sys.maxsize, None, None, None))
+            if page_id != cl_from:
+                continue
+            cat = normalize(cl_to.decode("utf-8", "replace"))
+            if namespace == b"14":
+                graph.add_subcat(cat, title)
+            elif namespace == b"0":
+                graph.add_page(cat, page_id, int(length))
+        # Flag the hidden categories after the last link
+        deque(pages, maxlen=0)
+    return graph
+
+
+def sqldump_extractor(inputfile_page_sql, inputfile_categorylinks_sql,
+                      hidden=None, budget=None):
+    # hidden: page ids of the hidden categories. With a memory budget (see
+    # graph_builder) the dumps are merge joined instead of holding all
+    # category titles
+    print("Extracting all categories and articles from %s and %s\n..." % (
+        inputfile_page_sql, inputfile_categorylinks_sql))
+    try:
+        if budget is not None:
+            return sqldump_merge_join(inputfile_page_sql,
+                                      inputfile_categorylinks_sql, hidden,
+                                      budget)
+        # Build side of the join on page_id: category titles and, by page
+        # id, the page_len + 1 of articles (0 for other pages)
+        category_titles = {}
+        article_lens = array("i")
+        graph = GraphBuilder()
+        with Stage("SQL page ingest") as stage:
+            for page_id, namespace, title, length in sql_dump_rows(
+                    inputfile_page_sql,
+                    ("page_id", "page_namespace", "page_title", "page_len"),
+                    stage):
+                if namespace == b"14":
+                    page_id = int(page_id)
+                    title = normalize(title.decode("utf-8", "replace"))
+                    category_titles[page_id] = title
+                    if hidden is not None and page_id in hidden:
+                        graph.hide(title)
+                elif namespace == b"0":
+                    page_id = int(page_id)
+                    if page_id >= len(article_lens):
+                        article_lens.frombytes(bytes(
+                            4 * (page_id - len(article_lens) + 1 + (1 << 20))))
+                    article_lens[page_id] = int(length) + 1
+        print("%s categories read from %s" % (
+            len(category_titles), inputfile_page_sql))
+        # Probe side: every category link
+        with Stage("SQL categorylinks ingest") as stage:
+            for cl_from, cl_to in sql_dump_rows(inputfile_categorylinks_sql,
+                                                ("cl_from", "cl_to"), stage):
+                page_id = int(cl_from)
+                cat = normalize(cl_to.decode("utf-8", "replace"))
+                subcat = category_titles.get(page_id)
+                if subcat is not None:
+                    graph.add_subcat(cat, subcat)
+                elif page_id < len(article_lens) and article_lens[page_id]:
+                    graph.add_page(cat, page_id, article_lens[page_id] - 1)
+    except FileNotFoundError as e:
+        print("Inputfile not found:", e.filename)
+        raise e
+    return graph
+
+
+def pruned_categories(graph, exclude=None, hidden=False, maxmembers=None):
+    # Mask of the categories closures must not enter, or None
+    hidden = hidden and graph.flags is not None and \
+        any(flags & FLAG_HIDDEN for flags in graph.flags)
+    if exclude is None and maxmembers is None and not hidden:
+        return None
+    pruned = bytearray(len(graph))
+    if hidden:
+        for id, flags in enumerate(graph.flags):
+            if flags & FLAG_HIDDEN:
+                pruned[id] = 1
+    if exclude is not None:
+        regex = re.compile(exclude)
+        for id, name in enumerate(graph.names):
+            if regex.search(name):
+                pruned[id] = 1
+    if maxmembers is not None:
+        subcat_offsets = graph.subcat_offsets
+        member_offsets = graph.member_offsets
+        for id in range(len(graph)):
+            if subcat_offsets[id + 1] - subcat_offsets[id] + \
+                    member_offsets[id + 1] - member_offsets[id] > maxmembers:
+                pruned[id] = 1
+    print("%s categories pruned" % pruned.count(1))
+    return pruned
+
+
+def pruned_fingerprint(graph, pruned):
+    # Identifies the closures of graph under the pruning mask
+    if pruned is None:
+        return graph.fingerprint
+    return "%s-%s" % (graph.fingerprint,
+                      hashlib.blake2b(pruned, digest_size=4).hexdigest())
+
+
+def closure_levels(graph, root, maxdepth, pruned=None):
+    # Level-synchronous BFS over category ids: levels[d] holds the ids first
+    # reached at depth d, in discovery order; pruned categories count as
+    # visited from the start
+    offsets = graph.subcat_offsets
+    subcats = graph.subcat_ids.cast("B")
+    size = graph.subcat_ids.itemsize
+    visited = bytearray(len(graph)) if pruned is None else bytearray(pruned)
+    visited[root] = 1
+    levels = [[root]]
+    while len(levels) <= maxdepth:
+        candidates = array("i")
+        for category in sorted(levels[-1]):
+            candidates.frombytes(subcats[offsets[category] * size:
+                                         offsets[category + 1] * size])
+        level = [s for s in dict.fromkeys(candidates) if not visited[s]]
+        if not level:
+            break
+        for s in level:
+            visited[s] = 1
+        levels.append(level)
+    return levels
+
+
+class ClosureCache(object):
+    # Closures saved as "<graph fingerprint>-<root id>-d<depth>.closure"
+    # stores, one per root, evicted least recently used first
+
+    def __init__(self, path, fingerprint, budget):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.budget = budget
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def entries(self, root):
+        prefix = "%s-%s-d" % (self.fingerprint, root)
+        for filename in os.listdir(self.path):
+            if filename.startswith(prefix) and filename.endswith(".closure"):
+                yield int(filename[len(prefix):-len(".closure")]), \
+                      os.path.join(self.path, filename)
+
+    def get(self, root, maxdepth):
+        # Any closure of root with depth >= maxdepth, or a complete one,
+        # answers the request once filtered on depth
+        for depth, path in self.entries(root):
+            try:
+                store = Store(path)
+            except (OSError, ValueError):
+                continue
+            if depth >= maxdepth or store.meta["complete"]:
+                os.utime(path)
+                levels = [[] for d in range(min(depth, maxdepth) + 1)]
+                for id, d in zip(store.array("ids"), store.array("depths")):
+                    if d <= maxdepth:
+                        levels[d].append(id)
+                while not levels[-1]:
+                    levels.pop()
+                return levels
+        return None
+
+    def put(self, root, maxdepth, levels):
+        ids = array("i")
+        depths = array("i")
+        for d, level in enumerate(levels):
+            ids.extend(level)
+            depths.extend([d] * len(level))
+        path = os.path.join(self.path, "%s-%s-d%s.closure" % (
+            self.fingerprint, root, maxdepth))
+        save_store(path, {"ids": ids, "depths": depths},
+                   {"complete": len(levels) <= maxdepth})
+        for depth, other in list(self.entries(root)):
+            if depth < maxdepth:
+                os.remove(other)
+        self.evict()
+
+    def evict(self):
+        entries = [os.path.join(self.path, filename)
+                   for filename in os.listdir(self.path)
+                   if filename.endswith(".closure")]
+        entries.sort(key=os.path.getmtime)
+        total = sum(os.path.getsize(path) for path in entries)
+        for path in entries:
+            if total <= self.budget:
+                break
+            total -= os.path.getsize(path)
+            os.remove(path)
+
+
+# Reachability index: strongly connected components of the pruned category
+# graph in topological order, and 2-hop labels (pruned landmark labeling)
+# giving the exact depth of every category within the index depth of
+# another: a pair is at the smallest out-label depth of the first plus
+# in-label depth of the second over the hubs they share
+LABEL_DEPTH_BITS = 8
+MAX_INDEX_DEPTH = (1 << LABEL_DEPTH_BITS) - 1
+
+
+def strongly_connected_components(graph, pruned=None):
+    # Iterative Tarjan over the graph without the links into pruned
+    # categories: the component of every category, numbered in topological
+    # order (links only go to components with a higher number)
+    n = len(graph)
+    offsets = graph.subcat_offsets
+    subcats = graph.subcat_ids
+    index = array("i", [-1]) * n
+    low = array("i", [0]) * n
+    component = array("i", [-1]) * n
+    on_stack = bytearray(n)
+    stack = []
+    counter = 0
+    count = 0
+    for start in range(n):
+        if index[start] != -1:
+            continue
+        index[start] = low[start] = counter
+        counter += 1
+        stack.append(start)
+        on_stack[start] = 1
+        work = [(start, offsets[start])]
+        while work:
+            v, i = work[-1]
+            end = offsets[v + 1]
+            while i < end:
+                w = subcats[i]
+                i += 1
+                if pruned is not None and pruned[w]:
+                    continue
+                if index[w] == -1:
+                    work[-1] = (v, i)
+                    index[w] = low[w] = counter
+                    counter += 1
+                    stack.append(w)
+                    on_stack[w] = 1
+                    work.append((w, offsets[w]))
+                    break
+                if on_stack[w] and index[w] < low[v]:
+                    low[v] = index[w]
+            else:
+                work.pop()
+                if work and low[v] < low[work[-1][0]]:
+                    low[work[-1][0]] = low[v]
+                if low[v] == index[v]:
+                    while True:
+                        w = stack.pop()
+                        on_stack[w] = 0
+                        component[w] = count
+                        if w == v:
+                            break
+                    count += 1
+    # Tarjan completes the components in reverse topological order
+    for v in range(n):
+        component[v] = count - 1 - component[v]
+    return component, count
+
+
+def label_depth(labels, hubs):
+    # Smallest depth through a hub of hubs ({hub: depth}) over labels, or
+    # MAX_INDEX_DEPTH + 1
+    best = MAX_INDEX_DEPTH + 1
+    for label in labels:
+        d = hubs.get(label >> LABEL_DEPTH_BITS)
+        if d is not None and d + (label & MAX_INDEX_DEPTH) < best:
+            best = d + (label & MAX_INDEX_DEPTH)
+    return best
+
+
+def pruned_bfs(root, hub, maxdepth, neighbours, hubs, labels, skip,
+               visited):
+    # Add (hub, depth) to the labels of the categories within maxdepth of
+    # root that the labels added so far do not already cover
+    touched = [root]
+    visited[root] = 1
+    frontier = [root]
+    depth = 0
+    while frontier:
+        next = []
+        for v in frontier:
+            if label_depth(labels[v], hubs) <= depth:
+                continue
+            labels[v].append(hub << LABEL_DEPTH_BITS | depth)
+            if depth == maxdepth:
+                continue
+            for w in neighbours(v):
+                if not visited[w] and not skip(v, w):
+                    visited[w] = 1
+                    touched.append(w)
+                    next.append(w)
+        frontier = next
+        depth += 1
+    for v in touched:
+        visited[v] = 0
+
+
+def build_reachability_index(path, graph, pruned, maxdepth, meta):
+    n = len(graph)
+    if maxdepth > MAX_INDEX_DEPTH or n >> (31 - LABEL_DEPTH_BITS):
+        raise ValueError("Reachability index depth %s or %s categories out "
+                         "of range" % (maxdepth, n))
+    with Stage("Reachability index", "categories", n) as stage:
+        component, count = strongly_connected_components(graph, pruned)
+        offsets = graph.subcat_offsets
+        parents = array("i")
+        for v in range(n):
+            parents.extend([v] * (offsets[v + 1] - offsets[v]))
+        parent_offsets, parent_ids = csr_arrays(graph.subcat_ids, parents,
+                                                n, "i")
+        parents = None
+
+        def subcats(v):
+            return graph.subcat_ids[offsets[v]:offsets[v + 1]]
+
+        def supercats(v):
+            return parent_ids[parent_offsets[v]:parent_offsets[v + 1]]
+
+        # Links into pruned categories are left out
+        def skip_down(v, w):
+            return pruned is not None and pruned[w]
+
+        def skip_up(v, w):
+            return pruned is not None and pruned[v]
+
+        # Hubs by decreasing degree, which cover the most pairs
+        order = sorted(range(n), key=lambda v: (
+            len(supercats(v)) + len(subcats(v))), reverse=True)
+        labels_in = [array("i") for v in range(n)]
+        labels_out = [array("i") for v in range(n)]
+        visited = bytearray(n)
+        for hub, v in enumerate(order):
+            hubs = {label >> LABEL_DEPTH_BITS: label & MAX_INDEX_DEPTH
+                    for label in labels_out[v]}
+            pruned_bfs(v, hub, maxdepth, subcats, hubs, labels_in,
+                       skip_down, visited)
+            hubs = {label >> LABEL_DEPTH_BITS: label & MAX_INDEX_DEPTH
+                    for label in labels_in[v]}
+            pruned_bfs(v, hub, maxdepth, supercats, hubs, labels_out,
+                       skip_up, visited)
+            stage.add()
+
+        # Categories by hub, ordered by depth, to enumerate closures
+        keys = array("i")
+        values = array("q")
+        for v, labels in enumerate(labels_in):
+            for label in labels:
+                keys.append(label >> LABEL_DEPTH_BITS)
+                values.append((label & MAX_INDEX_DEPTH) << 32 | v)
+        member_offsets, members = csr_arrays(keys, values, n, "q")
+        for hub in range(n):
+            a, b = member_offsets[hub], member_offsets[hub + 1]
+            if b - a > 1:
+                members[a:b] = array("q", sorted(members[a:b]))
+        arrays = {"components": component, "order": array("i", order),
+                  "hub_offsets": member_offsets, "hub_members": members}
+        for name, labels in (("in", labels_in), ("out", labels_out)):
+            label_offsets = array("q", [0])
+            flat = array("i")
+            for v in range(n):
+                flat.extend(labels[v])
+                label_offsets.append(len(flat))
+            arrays[name + "_offsets"] = label_offsets
+            arrays[name + "_labels"] = flat
+        save_store(path, arrays, dict(meta, maxdepth=maxdepth,
+                                      components=count))
+
+
+class ReachabilityIndex(object):
+    # Answers depth and closure queries up to the index depth from the
+    # labels; deeper closures are passed on to cache, which the index
+    # stands in for in getcategorydepths
+
+    def __init__(self, path, cache=None):
+        self.store = Store(path)
+        self.maxdepth = self.store.meta["maxdepth"]
+        self.components = self.store.array("components")
+        self.hub_offsets = self.store.array("hub_offsets")
+        self.hub_members = self.store.array("hub_members")
+        self.in_offsets = self.store.array("in_offsets")
+        self.in_labels = self.store.array("in_labels")
+        self.out_offsets = self.store.array("out_offsets")
+        self.out_labels = self.store.array("out_labels")
+        self.cache = cache
+
+    def labels(self, offsets, labels, v):
+        return labels[offsets[v]:offsets[v + 1]]
+
+    def depth(self, root, category):
+        # Depth of category below root, or None if it is deeper than the
+        # index depth or not below root at all
+        if self.components[root] > self.components[category]:
+            return None
+        hubs = {label >> LABEL_DEPTH_BITS: label & MAX_INDEX_DEPTH
+                for label in self.labels(self.out_offsets, self.out_labels,
+                                         root)}
+        depth = label_depth(self.labels(self.in_offsets, self.in_labels,
+                                        category), hubs)
+        return depth if depth <= self.maxdepth else None
+
+    def closure(self, root, maxdepth):
+        # Category -> depth for the categories within maxdepth of root
+        depths = {}
+        for label in self.labels(self.out_offsets, self.out_labels, root):
+            hub = label >> LABEL_DEPTH_BITS
+            d = label & MAX_INDEX_DEPTH
+            for member in self.hub_members[self.hub_offsets[hub]:
+                                           self.hub_offsets[hub + 1]]:
+                depth = d + (member >> 32)
+                if depth > maxdepth:
+                    break
+                v = member & 0xffffffff
+                if depths.get(v, depth + 1) > depth:
+                    depths[v] = depth
+        return depths
+
+    def get(self, root, maxdepth):
+        if maxdepth > self.maxdepth:
+            return self.cache.get(root, maxdepth) \
+                if self.cache is not None else None
+        levels = [[] for d in range(maxdepth + 1)]
+        for v, depth in self.closure(root, maxdepth).items():
+            levels[depth].append(v)
+        while not levels[-1]:
+            levels.pop()
+        return levels
+
+    def put(self, root, maxdepth, levels):
+        if self.cache is not None:
+            self.cache.put(root, maxdepth, levels)
+
+
+def cached_closure_levels(graph, root, maxdepth, cache=None, pruned=None):
+    levels = cache.get(root, maxdepth) if cache is not None else None
+    if levels is None:
+        levels = closure_levels(graph, root, maxdepth, pruned)
+        if cache is not None:
+            cache.put(root, maxdepth, levels)
+    return levels
+
+
+def getcategorydepths(graph, wantedcategory, maxdepth, cache=None,
+                      pruned=None):
     print("\nCollecting all subcategories for \'%s\' (Max depth: %s)" % (
         wantedcategory, maxdepth))
     cat_depth = defaultdict(int)
-    if not wantedcategory in cat_to_subcats.keys():
+    root = graph.id(wantedcategory)
+    if root == -1:
         return cat_depth
-    cat_depth[wantedcategory] = 0
-    queue = PriorityQueue()
-    queue.put((0, wantedcategory))
-    while not queue.empty():
-        (d, category) = queue.get()
-        if d >= maxdepth:
-            #            print(
-            #                "Maximum depth %s reached. Next subcategory in queue: \'%s\'" % (
-            #                    d, category))
-            break
-        try:
-            subcategories = cat_to_subcats[category]
-            for s in subcategories:
-                if s not in cat_depth.keys():
-                    cat_depth[s] = d + 1
-                    queue.put((d + 1, s))
-        except KeyError:
-            print(
-                "KeyError: Skipped category \'%s\'" % category)
-            cat_depth.pop(category, None)
-            continue
+    with Stage("BFS", "categories") as stage:
+        levels = cached_closure_levels(graph, root, maxdepth, cache, pruned)
+        for d, level in enumerate(levels):
+            for id in level:
+                cat_depth[graph.name(id)] = d
+            stage.add(len(level))
     print("Found %s categories for starting category \'%s\', max depth %s)" % (
         len(cat_depth), wantedcategory, maxdepth))
     return cat_depth
 
 
-def getsubcats(cat_to_subcats, cat_depth):
-    categorylinks = {}
-    for cat in cat_depth.keys():
-        if cat in cat_to_subcats.keys():
-            categorylinks[cat] = cat_to_subcats[cat]
-    return categorylinks
+def save_selection(path, graph, cat_depth, meta):
+    # Save the collected categories of a job and the subcategories they link
+    # to as a graph store: names in name order (graph ids are), the depth of
+    # every collected category (-1 for the others), its subcategories and its
+    # articles
+    print("Collecting article ids for %s categories..." % len(cat_depth))
+    with Stage("Id collection", "ids") as stage:
+        depth = {}
+        for cat, d in cat_depth.items():
+            id = graph.id(cat)
+            if id != -1:
+                depth[id] = d
+        ids = set(depth)
+        for id in depth:
+            ids.update(graph.subcats(id))
+        ids = sorted(ids)
+        rank = {id: i for i, id in enumerate(ids)}
+        depths = array("i", (depth.get(id, -1) for id in ids))
+        subcat_offsets, subcats = array("q", [0]), array("i")
+        member_offsets, members = array("q", [0]), array("i")
+        for id in ids:
+            if id in depth:
+                subcats.extend(rank[s] for s in graph.subcats(id))
+                members.frombytes(graph.members(id).tobytes())
+            subcat_offsets.append(len(subcats))
+            member_offsets.append(len(members))
+        stage.add(len(members))
+        data, name_offsets = string_arrays(graph.name(id) for id in ids)
+        save_store(path, {"names": data, "names_offsets": name_offsets,
+                          "subcat_offsets": subcat_offsets,
+                          "subcats": subcats,
+                          "member_offsets": member_offsets,
+                          "members": members, "depths": depths}, meta)
+    print("Article ids collected: %s" % stage.rows)
 
 
-def collectArticleIds(path, cat_to_depth):
-    print("Collecting article ids for \'%s\' (Max depth: %s)..." % (
-        wantedCategory, maxDepth))
-    start = time.time()
-    try:
-        with open(path, "r", encoding="latin-1") as csv_file:
-            dialect = csv.Sniffer().sniff(csv_file.read(1024))
-            dialect.escapechar = "\\"
-            # dialect.quotechar = "|"
-            dialect.quoting = csv.QUOTE_MINIMAL
-            csv_file.seek(0)
-            reader = csv.reader(csv_file, dialect)
-            category_to_articleids = defaultdict(list)
-            count = 0
-            for line in reader:
-                try:
-                    page_id = line[0]
-                    cl_to = line[2]
-                    if cl_to in cat_to_depth.keys():
-                        category_to_articleids[cl_to].append(page_id)
-                        count += 1
-                except:
-                    print("Skipped line: %s" % line)
-                    continue
-            end = time.time()
-            print("Article ids collected: %s" % count)
-            printTime(start, end)
-            return category_to_articleids
-    except FileNotFoundError as e:
-        print("Inputfile not found:\n", path)
-        raise e
+class Selection(CategoryGraph):
+    # Categories collected by a job, saved by save_selection: depths[i] is
+    # the depth of category i, -1 if it is only listed as a subcategory of a
+    # collected category (past maxDepth or pruned). Load it with
+    # Selection(path) to look up categories without parsing the exports
+
+    def __init__(self, path):
+        CategoryGraph.__init__(self, path)
+        self.depths = self.store.array("depths")
+
+    def depth(self, id):
+        return self.depths[id]
+
+    def collected(self):
+        return (id for id in range(len(self)) if self.depths[id] != -1)
+
+    def category_to_depth(self):
+        return {self.name(id): self.depths[id] for id in self.collected()}
+
+    def categorylinks(self):
+        return {self.name(id): [self.name(s) for s in self.subcats(id)]
+                for id in self.collected()}
+
+    def category_to_articleids(self):
+        return {self.name(id): self.members(id).tolist()
+                for id in self.collected() if len(self.members(id))}
+
+
+# Exports of a Selection: file suffix and the dictionary saved
+SELECTION_EXPORTS = {
+    "category_to_depth": Selection.category_to_depth,
+    "categorylinks": Selection.categorylinks,
+    "category_to_articleids": Selection.category_to_articleids}
+EXPORT_WRITERS = {"csv": save_as_csv, "json": save_as_json}
+
+
+def export_selection(selection, prefix, maxdepth, formats, update=False):
+    # Save the selection as .csv/.json files, if missing or update
+    for name, export in SELECTION_EXPORTS.items():
+        filepaths = [(prefix + "_" + name + "-d" + str(maxdepth) + "." +
+                      format, EXPORT_WRITERS[format]) for format in formats]
+        if update or not all(os.path.exists(filepath)
+                             for filepath, writer in filepaths):
+            exported = export(selection)
+            for filepath, writer in filepaths:
+                writer(exported, filepath)
 
 
 # XML Headers
@@ -206,6 +1810,10 @@ Ttitle = Tagheader + "title"
 Tid = Tagheader + "id"
 Trev = Tagheader + "revision"
 Ttext = Tagheader + "text"
+Tns = Tagheader + "ns"
+Tredirect = Tagheader + "redirect"
+MEDIAWIKI_START = ('<mediawiki xmlns="%s">' % Header).encode("utf-8")
+MEDIAWIKI_END = b"</mediawiki>"
 
 
 def create_subelem(parent, name, content):
@@ -214,135 +1822,1366 @@ def create_subelem(parent, name, content):
     return newchild
 
 
-def create_page(elem, title_path, id_path, text_path, articleids, newfile):
+OUTPUT_EXTENSIONS = {"none": ".xml", "gzip": ".xml.gz", "bz2": ".xml.bz2",
+                     "zstd": ".xml.zst"}
+COMPRESS_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def compress_zstd(data, level):
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+class BlockCompressor(object):
+    # Write-only file compressing blocks of its input independently on a
+    # thread pool and writing them in order, like pbzip2 or multi-member
+    # gzip: the result is a valid multi-stream .bz2/.gz/.zst file
+
+    def __init__(self, path, compress, threads, blocksize, offset=None):
+        self.file = open_at(path, offset)
+        self.compress = compress
+        self.threads = threads
+        self.blocksize = blocksize
+        self.pool = ThreadPoolExecutor(threads)
+        self.pending = deque()
+        self.buffer = []
+        self.size = 0
+
+    def write(self, data):
+        self.buffer.append(bytes(data))
+        self.size += len(data)
+        if self.size >= self.blocksize:
+            self.submit()
+        return len(data)
+
+    def submit(self):
+        if self.buffer:
+            self.pending.append(self.pool.submit(self.compress,
+                                                 b"".join(self.buffer)))
+            self.buffer = []
+            self.size = 0
+        while len(self.pending) > 2 * self.threads:
+            self.file.write(self.pending.popleft().result())
+
+    def flush(self):
+        # Ends the current stream
+        self.submit()
+        while self.pending:
+            self.file.write(self.pending.popleft().result())
+        self.file.flush()
+
+    def tell(self):
+        return self.file.tell()
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.pool.shutdown()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_at(path, offset=None):
+    # Open path for writing, or reopen it keeping its first offset bytes
+    if offset is None:
+        return open(path, "wb")
+    file = open(path, "r+b")
+    file.truncate(offset)
+    file.seek(offset)
+    return file
+
+
+def open_output(path, codec="bz2", compresslevel=9, threads=1, offset=None):
+    # offset: continue an output flushed at that size by an earlier run
+    if codec == "none":
+        return open_at(path, offset)
+    if codec == "gzip":
+        compress = partial(gzip.compress, compresslevel=compresslevel,
+                           mtime=0)
+        blocksize = COMPRESS_BLOCK_SIZE
+    elif codec == "bz2":
+        # One bz2 stream per bz2 block of the chosen level
+        compress = partial(bz2.compress, compresslevel=compresslevel)
+        blocksize = compresslevel * 100000
+    elif codec == "zstd":
+        if zstandard is None:
+            raise ValueError("The zstd codec needs the zstandard package")
+        compress = partial(compress_zstd, level=compresslevel)
+        blocksize = COMPRESS_BLOCK_SIZE
+    else:
+        raise ValueError("Unknown output codec: %s" % codec)
+    return BlockCompressor(path, compress, threads, blocksize, offset)
+
+
+def output_shards(outpath, shards):
+    # The file listing the shards of the output outpath and the shard files:
+    # outpath itself, or <name>-<i><extension> next to <name>.shards.json
+    if shards <= 1:
+        return outpath, [outpath]
+    extension = max((e for e in OUTPUT_EXTENSIONS.values()
+                     if outpath.endswith(e)), key=len)
+    name = outpath[:-len(extension)]
+    return name + ".shards.json", ["%s-%03d%s" % (name, i, extension)
+                                   for i in range(shards)]
+
+
+class ShardedOutput(object):
+    # Article output spread over shard files of similar size: every page
+    # goes to the smallest shard so far and every shard is a complete
+    # mediawiki document with its own siteinfo
+
+    def __init__(self, paths, codec, compresslevel, threads, state=None):
+        self.paths = paths
+        if state is None:
+            state = {"offsets": [None] * len(paths),
+                     "sizes": [0] * len(paths), "counts": [0] * len(paths)}
+        self.files = [open_output(path, codec, compresslevel, threads,
+                                  offset)
+                      for path, offset in zip(paths, state["offsets"])]
+        self.sizes = list(state["sizes"])
+        self.counts = list(state["counts"])
+
+    def write_all(self, data):
+        for file in self.files:
+            file.write(data)
+
+    def write_page(self, data):
+        i = self.sizes.index(min(self.sizes))
+        self.files[i].write(data)
+        self.sizes[i] += len(data)
+        self.counts[i] += 1
+
+    def count(self):
+        return sum(self.counts)
+
+    def state(self):
+        # Flush every shard to a stream boundary first
+        for file in self.files:
+            file.flush()
+        return {"offsets": [file.tell() for file in self.files],
+                "sizes": self.sizes, "counts": self.counts}
+
+    def shards(self):
+        return [{"path": os.path.basename(path), "pages": count,
+                 "bytes": size}
+                for path, count, size in zip(self.paths, self.counts,
+                                             self.sizes)]
+
+    def close(self):
+        for file in self.files:
+            file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def page_xpaths():
+    return (etree.ETXPath("child::" + Ttitle),
+            etree.ETXPath("child::" + Tid),
+            etree.ETXPath("child::" + Trev + "/" + Ttext))
+
+
+def build_page(elem, title_path, id_path, text_path):
     id = id_path(elem)[0].text
     title = normalize(title_path(elem)[0].text)
-    text = clean_text(text_path(elem)[0].text, regexps_dict)
+    text = TEXT_CLEANERS[textCleaner](text_path(elem)[0].text)
     newpage = etree.Element("page")
     create_subelem(newpage, "title", title)
     create_subelem(newpage, "id", id)
     create_subelem(etree.SubElement(newpage, "revision"), "text", text)
-    newfile.write(newpage, pretty_print=True)
+    return newpage
 
 
-def create_namespace(elem, newfile):
+def page_data(elem, title_path, id_path, text_path):
+    return etree.tostring(build_page(elem, title_path, id_path, text_path),
+                          pretty_print=True, encoding="utf-8")
+
+
+def create_namespace(elem):
     newnamespaces = etree.Element("namespaces")
-    with newfile.element("siteinfo"):
-        for child in elem:
-            nc = create_subelem(newnamespaces, "namespace", child.text)
-            for k, v in child.attrib.items():
-                nc.attrib[k] = v
-        newfile.write(newnamespaces, pretty_print=True)
-
-
-def articlecollector(path_articles_xml, outpath_articles, articleids):
-    print("\nCollecting articles for \'%s\' from %s\n..." % (
-        wantedCategory, path_articles_xml))
-    title_path = etree.ETXPath("child::" + Ttitle)
-    id_path = etree.ETXPath("child::" + Tid)
-    text_path = etree.ETXPath("child::" + Trev + "/" + Ttext)
-    extracted_count = 0
-    start = time.time()
+    for child in elem:
+        nc = create_subelem(newnamespaces, "namespace", child.text)
+        for k, v in child.attrib.items():
+            nc.attrib[k] = v
+    return b"<siteinfo>" + etree.tostring(
+        newnamespaces, pretty_print=True, encoding="utf-8") + b"</siteinfo>"
+
+
+# Raw dump markers used to locate pages without parsing them
+PAGE_START = b"<page>"
+PAGE_END = b"</page>"
+ID_START = b"<id>"
+ID_END = b"</id>"
+SITEINFO_END = b"</siteinfo>"
+NAMESPACES_START = b"<namespaces>"
+NAMESPACES_END = b"</namespaces>"
+FRAGMENT_START = ('<mediawiki xmlns="%s">' % Header).encode("utf-8")
+FRAGMENT_END = b"</mediawiki>"
+SCAN_CHUNK_SIZE = 16 * 1024 * 1024
+HEADER_CHUNK_SIZE = 64 * 1024
+
+# Persistent page id -> byte offset catalog for uncompressed XML dumps
+CATALOG_SUFFIX = ".pageindex"
+CATALOG_MAGIC = b"PAGEIDX1"
+CATALOG_HEADER = struct.Struct("<8sqqq")
+
+
+def get_page_id(elem):
+    return int(elem.findtext(Tid))
+
+
+def parse_fragment(data):
+    # Parse a sequence of dump elements lacking the enclosing <mediawiki>
+    return etree.fromstring(FRAGMENT_START + data + FRAGMENT_END)
+
+
+def read_namespaces(data):
+    start = data.find(NAMESPACES_START)
+    end = data.find(NAMESPACES_END, start)
+    if start == -1 or end == -1:
+        return None
+    return parse_fragment(data[start:end + len(NAMESPACES_END)])[0]
+
+
+def read_header(f):
+    # Read the start of a dump up to the end of its <siteinfo>
+    data = b""
+    while SITEINFO_END not in data:
+        chunk = f.read(HEADER_CHUNK_SIZE)
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def iterpages(f, start=0, end=None):
+    # Yield (page_id, offset, data) for every <page> starting in [start, end)
+    # of the raw dump bytes read from f. Only the page's first <id> is looked
+    # at; data is a zero-copy view, valid until the next page is requested
+    f.seek(start)
+    base = start
+    buf = b""
+    i = 0
+    eof = False
+    while True:
+        s = buf.find(PAGE_START, i)
+        e = buf.find(PAGE_END, s) if s != -1 else -1
+        if e == -1:
+            if eof:
+                return
+            keep = s if s != -1 else max(i, len(buf) - len(PAGE_START) + 1)
+            chunk = f.read(SCAN_CHUNK_SIZE)
+            eof = not chunk
+            base += keep
+            buf = buf[keep:] + chunk
+            i = 0
+            continue
+        if end is not None and base + s >= end:
+            return
+        e += len(PAGE_END)
+        a = buf.find(ID_START, s, e) + len(ID_START)
+        page_id = int(buf[a:buf.find(ID_END, a, e)])
+        yield page_id, base + s, memoryview(buf)[s:e]
+        i = e
+
+
+def multistream_index_path(path_articles_xml):
+    # enwiki-...-multistream.xml.bz2 -> enwiki-...-multistream-index.txt.bz2
+    if not path_articles_xml.endswith(".xml.bz2"):
+        return None
+    path_index = path_articles_xml[:-len(".xml.bz2")] + "-index.txt.bz2"
+    return path_index if os.path.isfile(path_index) else None
+
+
+def read_bz2_stream(f, offset, length=None):
+    # Decompress the bz2 stream at offset, length bytes long if known
+    f.seek(offset)
+    if length is not None:
+        return bz2.BZ2Decompressor().decompress(f.read(length))
+    decompressor = bz2.BZ2Decompressor()
+    data = []
+    while not decompressor.eof:
+        chunk = f.read(HEADER_CHUNK_SIZE)
+        if not chunk:
+            break
+        data.append(decompressor.decompress(chunk))
+    return b"".join(data)
+
+
+def multistream_offsets(path_index, articleids, size):
+    # (offset, length) of the streams holding wanted pages. Index lines are
+    # "stream offset:page id:title" in dump order, so a stream ends where
+    # the next one starts, the last one at the dump's size
+    streams = []
+    start = None
+    wanted = False
+    with BZ2File(path_index, "r") as f:
+        for line in f:
+            offset, page_id, _ = line.split(b":", 2)
+            offset = int(offset)
+            if offset != start:
+                if wanted:
+                    streams.append((start, offset - start))
+                start = offset
+                wanted = False
+            if not wanted and int(page_id) in articleids:
+                wanted = True
+    if wanted:
+        streams.append((start, size - start))
+    return streams
+
+
+def stream_offset_pages(f, streams, articleids, catalog=None, stage=None):
+    for offset, length in streams:
+        stream = io.BytesIO(read_bz2_stream(f, offset, length))
+        if stage is not None:
+            stage.add_read(length)
+        for page_id, page_offset, data in iterpages(stream):
+            if page_id in articleids:
+                yield parse_fragment(data)[0]
+
+
+def multistream_pages(path_articles_xml, path_index, articleids,
+                      stage=None):
+    streams = multistream_offsets(path_index, articleids,
+                                  os.path.getsize(path_articles_xml))
+    print("%s of the dump's bz2 streams hold wanted articles" % len(streams))
+    with open(path_articles_xml, "rb") as f:
+        namespaces = read_namespaces(read_bz2_stream(f, 0))
+        if stage is not None:
+            stage.add_read(f.tell())
+        if namespaces is not None:
+            yield namespaces
+        yield from stream_offset_pages(f, streams, articleids, stage=stage)
+
+
+def stream_pages(path_articles_xml, articleids, stage=None):
+    with open(path_articles_xml, "rb") as raw, BZ2File(raw, "r") as f:
+        if stage is not None:
+            stage.track(path_articles_xml, raw)
+        namespaces = read_namespaces(read_header(f))
+        if namespaces is not None:
+            yield namespaces
+        for page_id, offset, data in iterpages(f):
+            if page_id in articleids:
+                yield parse_fragment(data)[0]
+
+
+def catalog_path(path_articles_xml):
+    return path_articles_xml + CATALOG_SUFFIX
+
+
+def new_catalog():
+    return array("i"), array("q"), array("i")
+
+
+def load_catalog(path_articles_xml):
+    path = catalog_path(path_articles_xml)
+    if not os.path.isfile(path):
+        return None
+    stat = os.stat(path_articles_xml)
+    with open(path, "rb") as f:
+        magic, size, mtime, count = CATALOG_HEADER.unpack(
+            f.read(CATALOG_HEADER.size))
+        if magic != CATALOG_MAGIC or size != stat.st_size or \
+                mtime != stat.st_mtime_ns:
+            print("Page catalog %s is outdated" % path)
+            return None
+        catalog = new_catalog()
+        for a in catalog:
+            a.fromfile(f, count)
+    return catalog
+
+
+def save_catalog(path_articles_xml, catalog):
+    path = catalog_path(path_articles_xml)
+    stat = os.stat(path_articles_xml)
+    with open(path + ".tmp", "wb") as f:
+        f.write(CATALOG_HEADER.pack(CATALOG_MAGIC, stat.st_size,
+                                    stat.st_mtime_ns, len(catalog[0])))
+        for a in catalog:
+            a.tofile(f)
+    os.replace(path + ".tmp", path)
+    print("%s saved." % path)
+
+
+def catalog_spans(catalog, articleids):
+    return [(offset, length) for page_id, offset, length in zip(*catalog)
+            if page_id in articleids]
+
+
+def span_pages(f, spans, articleids=None, catalog=None):
+    for offset, length in spans:
+        f.seek(offset)
+        yield parse_fragment(f.read(length))[0]
+
+
+def scanned_pages(f, byterange, articleids, catalog):
+    # Scan the raw dump bytes, adding every page seen to catalog
+    ids, offsets, lengths = catalog
+    for page_id, offset, data in iterpages(f, *byterange):
+        ids.append(page_id)
+        offsets.append(offset)
+        lengths.append(len(data))
+        if page_id in articleids:
+            yield parse_fragment(data)[0]
+
+
+def catalog_pages(path_articles_xml, articleids, stage=None):
+    catalog = load_catalog(path_articles_xml)
+    with open(path_articles_xml, "rb") as f:
+        if stage is not None:
+            stage.track(path_articles_xml, f)
+        namespaces = read_namespaces(read_header(f))
+        if namespaces is not None:
+            yield namespaces
+        if catalog is not None:
+            yield from span_pages(f, catalog_spans(catalog, articleids))
+            return
+        # First run: scan the whole dump once, building the catalog on the way
+        print("Building page catalog for %s" % path_articles_xml)
+        catalog = new_catalog()
+        yield from scanned_pages(f, (0, None), articleids, catalog)
+    save_catalog(path_articles_xml, catalog)
+
+
+def selectedpages(path_articles_xml, articleids, stage=None):
+    # Yield the <namespaces> element followed by the wanted <page> elements,
+    # reading as little of the dump as its format allows; stage follows the
+    # position in the dump
+    if path_articles_xml.endswith(".bz2"):
+        path_index = multistream_index_path(path_articles_xml)
+        if path_index is not None:
+            return multistream_pages(path_articles_xml, path_index,
+                                     articleids, stage)
+        return stream_pages(path_articles_xml, articleids, stage)
+    return catalog_pages(path_articles_xml, articleids, stage)
+
+
+# A parallel scan is cut into at least SCAN_PORTIONS_PER_WORKER portions per
+# worker, of at most SCAN_PORTION_BYTES of the dump each, so that finished
+# portions are merged, and checkpointed, all along the scan
+SCAN_PORTIONS_PER_WORKER = 8
+SCAN_PORTION_BYTES = 256 * 1024 * 1024
+
+
+def scan_portions(size, workers):
+    return max(workers * SCAN_PORTIONS_PER_WORKER,
+               -(-size // SCAN_PORTION_BYTES))
+
+
+def page_ranges(path_articles_xml, n):
+    # Split the dump into n byte ranges starting at <page> boundaries
+    size = os.path.getsize(path_articles_xml)
+    bounds = []
+    with open(path_articles_xml, "rb") as f:
+        for i in range(n):
+            offset = size
+            for page_id, offset, data in iterpages(f, size * i // n):
+                break
+            bounds.append(offset)
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:])
+            if start < end]
+
+
+def split_balanced(items, weights, n):
+    # Split items into at most n contiguous chunks of similar total weight
+    total = sum(weights)
+    chunks = [[]]
+    acc = 0
+    for item, weight in zip(items, weights):
+        if acc >= total * len(chunks) / n and len(chunks) < n:
+            chunks.append([])
+        chunks[-1].append(item)
+        acc += weight
+    return [chunk for chunk in chunks if chunk]
+
+
+def parallel_tasks(path_articles_xml, articleids, workers, outpaths):
+    # Plan the tasks of the workers: (page source, dump path, portion, part
+    # paths), in dump order
+    path_index = multistream_index_path(path_articles_xml)
+    if path_index is not None:
+        with open(path_articles_xml, "rb") as f:
+            namespaces = read_namespaces(read_bz2_stream(f, 0))
+        streams = multistream_offsets(path_index, articleids,
+                                      os.path.getsize(path_articles_xml))
+        source = stream_offset_pages
+        lengths = [l for o, l in streams]
+        portions = split_balanced(streams, lengths,
+                                  scan_portions(sum(lengths), workers))
+    elif path_articles_xml.endswith(".bz2"):
+        print("%s has no multistream index, scanning it sequentially" %
+              path_articles_xml)
+        return None, None
+    else:
+        with open(path_articles_xml, "rb") as f:
+            namespaces = read_namespaces(read_header(f))
+        catalog = load_catalog(path_articles_xml)
+        if catalog is not None:
+            spans = catalog_spans(catalog, articleids)
+            source = span_pages
+            lengths = [l for o, l in spans]
+            portions = split_balanced(spans, lengths,
+                                      scan_portions(sum(lengths), workers))
+        else:
+            print("Building page catalog for %s" % path_articles_xml)
+            source = scanned_pages
+            portions = page_ranges(path_articles_xml, scan_portions(
+                os.path.getsize(path_articles_xml), workers))
+    return namespaces, [(source, path_articles_xml, portion,
+                         ["%s.part%s" % (outpath, i) for outpath in outpaths])
+                        for i, portion in enumerate(portions)]
+
+
+worker_articleids = None
+worker_outputs = None
+
+
+def init_worker(outputs):
+    global worker_articleids, worker_outputs
+    worker_outputs = outputs
+    worker_articleids = PageIdSet()
+    for ids in outputs:
+        worker_articleids |= ids
+
+
+def collect_part(task):
+    # Worker: write the wanted pages of one portion of the dump to one part
+    # file per output
+    source, path_articles_xml, portion, partpaths = task
+    title_path, id_path, text_path = page_xpaths()
+    catalog = new_catalog()
+    lengths = [array("i") for partpath in partpaths]
+    page_ids = array("i")
+    with open(path_articles_xml, "rb") as f, ExitStack() as stack:
+        parts = [stack.enter_context(open(partpath, "wb"))
+                 for partpath in partpaths]
+        for elem in source(f, portion, worker_articleids, catalog):
+            page_id = get_page_id(elem)
+            data = page_data(elem, title_path, id_path, text_path)
+            for i, ids in enumerate(worker_outputs):
+                if page_id in ids:
+                    parts[i].write(data)
+                    lengths[i].append(len(data))
+            page_ids.append(page_id)
+    return lengths, catalog, page_ids
+
+
+def merge_parts(tasks, outputs, workers, writers, checkpoint, stage):
+    # Run the tasks in a process pool, adding the pages of the part files to
+    # the outputs in dump order
+    catalogs = []
     try:
-        with BZ2File(outpath_articles, "w", compresslevel=9) as file, \
-                etree.xmlfile(file, encoding="utf-8") as newfile, \
-                newfile.element("mediawiki",
-                                xmlns=Header):
-            context = etree.iterparse(path_articles_xml,
-                                      events=("end",),
-                                      tag={Tnamespaces, Tpage})
-            for action, elem in context:
-                if elem.tag == Tpage and id_path(elem)[
-                    0].text in articleids:
-                    create_page(elem, title_path, id_path, text_path,
-                                articleids, newfile)
-                    extracted_count += 1
-                elif elem.tag == Tnamespaces:
-                    create_namespace(elem, newfile)
-                elem.clear()
-                while elem.getprevious() is not None:
-                    del elem.getparent()[0]
+        with Pool(min(workers, len(tasks)), initializer=init_worker,
+                  initargs=([ids for outpath, ids in outputs],)) as pool:
+            for task, (lengths, catalog, page_ids) in zip(
+                    tasks, pool.imap(collect_part, tasks)):
+                for writer, partpath, part_lengths in zip(writers, task[3],
+                                                          lengths):
+                    with open(partpath, "rb") as part:
+                        for length in part_lengths:
+                            writer.write_page(part.read(length))
+                    os.remove(partpath)
+                checkpoint.done.extend(page_ids)
+                stage.add(len(page_ids))
+                if checkpoint.due():
+                    checkpoint.save(writers)
+                catalogs.append(catalog)
+    finally:
+        # Part files of portions not merged when the scan was interrupted
+        for task in tasks:
+            for partpath in task[3]:
+                if os.path.isfile(partpath):
+                    os.remove(partpath)
+    if tasks[0][0] is scanned_pages:
+        catalog = new_catalog()
+        for part in catalogs:
+            for a, b in zip(catalog, part):
+                a.extend(b)
+        save_catalog(tasks[0][1], catalog)
+
+
+# Seconds between checkpoints of the article dump scan
+CHECKPOINT_INTERVAL = 300
+
+
+class ScanCheckpoint(object):
+    # Records which pages of the dump have been written to the outputs and
+    # the state of every output (flushed shard sizes, page counts), so that
+    # an interrupted scan resumes where it left off instead of starting over
+
+    def __init__(self, path, manifest, shardpaths):
+        self.path = path
+        self.manifest = manifest
+        self.done = array("i")
+        self.states = [None] * len(shardpaths)
+        self.last = time.time()
+        if os.path.isfile(path):
+            store = Store(path)
+            states = store.meta["states"]
+            if store.meta["manifest"] == manifest and all(
+                    os.path.isfile(shardpath) and
+                    os.path.getsize(shardpath) >= offset
+                    for paths, state in zip(shardpaths, states)
+                    for shardpath, offset in zip(paths, state["offsets"])):
+                self.done.frombytes(store.array("done").cast("B"))
+                self.states = states
+
+    def due(self):
+        return time.time() - self.last >= CHECKPOINT_INTERVAL
+
+    def save(self, writers):
+        self.states = [writer.state() for writer in writers]
+        save_store(self.path, {"done": self.done},
+                   {"manifest": self.manifest, "states": self.states})
+        self.last = time.time()
+
+    def remove(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+def articlecollector(path_articles_xml, outputs, workers=1, codec="bz2",
+                     compresslevel=9, threads=1, shards=1):
+    # outputs: (output path, wanted article ids) per job; every selected page
+    # is written to all outputs wanting it, spread over shards files per
+    # output. Outputs already collected from the same dump and ids are kept
+    # as they are
+    outputs = [(outpath, page_id_set(ids)) for outpath, ids in outputs]
+    manifests = [stage_manifest([file_fingerprint(path_articles_xml)],
+                                ids=ids.digest(), codec=codec,
+                                compresslevel=compresslevel, shards=shards)
+                 for outpath, ids in outputs]
+    extracted_counts = []
+    pending = []
+    for (outpath, ids), manifest in zip(outputs, manifests):
+        listpath, shardpaths = output_shards(outpath, shards)
+        saved = current_manifest(listpath, manifest)
+        if saved is not None:
+            print("%s is up to date" % listpath)
+            extracted_counts.append(saved["results"]["count"])
+        else:
+            extracted_counts.append(None)
+            pending.append(len(extracted_counts) - 1)
+    if not pending:
+        return extracted_counts
+    print("\nCollecting articles for %s jobs from %s\n..." % (
+        len(pending), path_articles_xml))
+    shardpaths = [output_shards(outputs[i][0], shards)[1] for i in pending]
+    checkpoint = ScanCheckpoint(shardpaths[0][0] + ".checkpoint",
+                                [[outputs[i][0], manifests[i]]
+                                 for i in pending], shardpaths)
+    if checkpoint.done:
+        print("Resuming after %s articles" % len(checkpoint.done))
+    writers = collect_articles(path_articles_xml,
+                               [outputs[i] for i in pending], shardpaths,
+                               workers, codec, compresslevel, threads,
+                               checkpoint)
+    for i, writer in zip(pending, writers):
+        listpath = output_shards(outputs[i][0], shards)[0]
+        if shards > 1:
+            with open(listpath, "w", encoding="utf-8") as f:
+                json.dump({"pages": writer.count(),
+                           "shards": writer.shards()}, f, indent=1)
+        save_manifest(listpath, manifests[i], count=writer.count())
+        extracted_counts[i] = writer.count()
+    checkpoint.remove()
+    return extracted_counts
+
+
+def collect_articles(path_articles_xml, outputs, shardpaths, workers, codec,
+                     compresslevel, threads, checkpoint):
+    title_path, id_path, text_path = page_xpaths()
+    articleids = PageIdSet()
+    for outpath, ids in outputs:
+        articleids |= ids
+    articleids.difference_update(checkpoint.done)
+    tasks = None
+    if workers > 1:
+        namespaces, tasks = parallel_tasks(
+            path_articles_xml, articleids, workers,
+            [outpath for outpath, ids in outputs])
+    try:
+        with Stage("XML scan", "pages", len(articleids)) as stage, \
+                ExitStack() as stack:
+            writers = [stack.enter_context(ShardedOutput(
+                           paths, codec, compresslevel, threads, state))
+                       for paths, state in zip(shardpaths,
+                                               checkpoint.states)]
+            resumed = checkpoint.states[0] is not None
+            if not resumed:
+                for writer in writers:
+                    writer.write_all(MEDIAWIKI_START)
+            if tasks is not None:
+                if namespaces is not None and not resumed:
+                    for writer in writers:
+                        writer.write_all(create_namespace(namespaces))
+                if tasks:
+                    merge_parts(tasks, outputs, workers, writers, checkpoint,
+                                stage)
+            else:
+                for elem in selectedpages(path_articles_xml, articleids,
+                                          stage):
+                    if elem.tag == Tpage:
+                        stage.add()
+                        page_id = get_page_id(elem)
+                        data = page_data(elem, title_path, id_path,
+                                         text_path)
+                        for writer, (outpath, ids) in zip(writers, outputs):
+                            if page_id in ids:
+                                writer.write_page(data)
+                        checkpoint.done.append(page_id)
+                        if checkpoint.due():
+                            checkpoint.save(writers)
+                    elif elem.tag == Tnamespaces and not resumed:
+                        for writer in writers:
+                            writer.write_all(create_namespace(elem))
+            for writer in writers:
+                writer.write_all(MEDIAWIKI_END)
     except FileNotFoundError as e:
         print(e.filename, "not found")
         raise e
-    end = time.time()
-    printTime(start, end)
-    return extracted_count
+    return writers
+
+
+# Pages waiting for each extraction
+EXTRACT_QUEUE_SIZE = 1000
+
+
+def extraction_page(elem, title_path, id_path, text_path):
+    # The (id, revid, title, ns, page lines) tuple WikiExtractor's pages_from
+    # reads back from the XML file build_page would have written
+    revision = elem.find(Trev)
+    revid = revision.findtext(Tid) if revision is not None else None
+    title = escape(normalize(title_path(elem)[0].text))
+    text = TEXT_CLEANERS[textCleaner](text_path(elem)[0].text).decode("ascii")
+    return (id_path(elem)[0].text, revid, title, elem.findtext(Tns) or "0",
+            escape(text).splitlines(True))
+
+
+def feed(queue, thread, item):
+    # Stop feeding an extraction that died instead of blocking on its queue
+    while thread.is_alive():
+        try:
+            queue.put(item, timeout=1)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def extraction_pages(queue, started):
+    # The pages fed to an extraction; started is set once it asks for the
+    # first one, its processes being forked by then
+    started.set()
+    yield from iter(queue.get, None)
+
+
+def extract_articles(path_articles_xml, outputs, extractor_args):
+    # outputs: (output directory, wanted article ids) per job; the selected
+    # pages are handed to one WikiExtractor extraction per job while the
+    # dump is scanned, without writing them to disk in between
+    outputs = [(outdir, page_id_set(ids)) for outdir, ids in outputs]
+    manifests = [stage_manifest([file_fingerprint(path_articles_xml)],
+                                ids=ids.digest(),
+                                extractor_args=list(extractor_args))
+                 for outdir, ids in outputs]
+    extracted_counts = [None] * len(outputs)
+    for i, (outdir, ids) in enumerate(outputs):
+        saved = current_manifest(outdir, manifests[i])
+        if saved is not None:
+            print("%s is up to date" % outdir)
+            extracted_counts[i] = saved["results"]["count"]
+    pending = [i for i, count in enumerate(extracted_counts) if count is None]
+    if not pending:
+        return extracted_counts
+    if WIKIEXTRACTOR_PATH not in sys.path:
+        sys.path.insert(0, WIKIEXTRACTOR_PATH)
+    import WikiExtractor
+    print("\nExtracting articles for %s jobs from %s\n..." % (
+        len(pending), path_articles_xml))
+    parsed = WikiExtractor.parse_options([path_articles_xml] +
+                                         list(extractor_args))
+    if parsed is None:
+        raise ValueError("Invalid WikiExtractor arguments: %s" %
+                         extractor_args)
+    args, file_size = parsed
+    title_path, id_path, text_path = page_xpaths()
+    articleids = PageIdSet()
+    for i in pending:
+        articleids |= outputs[i][1]
+    finished = set()
+    # The jobs share the --processes extraction processes
+    processes = max(1, args.processes // len(pending))
+    if len(pending) > 1:
+        print("%s extraction processes per job" % processes)
+
+    def extraction(i, queue, started):
+        # The dump itself is only read for its siteinfo
+        WikiExtractor.process_dump(path_articles_xml, args.templates,
+                                   outputs[i][0], file_size, args.compress,
+                                   processes,
+                                   pages=extraction_pages(queue, started))
+        finished.add(i)
+
+    queues = []
+    threads = []
+    for i in pending:
+        queue = Queue(EXTRACT_QUEUE_SIZE)
+        started = Event()
+        thread = Thread(target=extraction, args=(i, queue, started))
+        thread.start()
+        # Let each extraction fork its processes while the others wait for
+        # pages, so that no thread holds a lock while a process is forked
+        while not started.wait(1) and thread.is_alive():
+            pass
+        queues.append(queue)
+        threads.append(thread)
+        extracted_counts[i] = 0
+    try:
+        with Stage("XML scan", "pages", len(articleids)) as stage:
+            try:
+                for elem in selectedpages(path_articles_xml, articleids,
+                                          stage):
+                    if elem.tag != Tpage:
+                        continue
+                    stage.add()
+                    if elem.find(Tredirect) is not None:
+                        continue
+                    page_id = get_page_id(elem)
+                    page = extraction_page(elem, title_path, id_path,
+                                           text_path)
+                    for i, queue, thread in zip(pending, queues, threads):
+                        if page_id in outputs[i][1] and \
+                                feed(queue, thread, page):
+                            extracted_counts[i] += 1
+            finally:
+                for queue, thread in zip(queues, threads):
+                    feed(queue, thread, None)
+                for thread in threads:
+                    thread.join()
+    except FileNotFoundError as e:
+        print(e.filename, "not found")
+        raise e
+    for i in pending:
+        if i in finished:
+            save_manifest(outputs[i][0], manifests[i],
+                          count=extracted_counts[i])
+    return extracted_counts
+
+
+# Graph server (graph_server.py) address: "host:port" or "unix:<path>" for a
+# Unix socket
+def server_address(address):
+    if address.startswith("unix:"):
+        return address[len("unix:"):]
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path, timeout=None):
+        http.client.HTTPConnection.__init__(self, "localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class GraphClient(object):
+    # Queries a running graph server; connection failures raise OSError and
+    # rejected queries ValueError
+
+    def __init__(self, address, timeout=None):
+        self.address = server_address(address)
+        self.timeout = timeout
+
+    def request(self, query, **params):
+        if isinstance(self.address, str):
+            connection = UnixHTTPConnection(self.address, self.timeout)
+        else:
+            connection = http.client.HTTPConnection(*self.address,
+                                                    timeout=self.timeout)
+        try:
+            connection.request("GET", "/%s?%s" % (
+                query, urllib.parse.urlencode(params, doseq=True)))
+            response = connection.getresponse()
+            data = response.read()
+        finally:
+            connection.close()
+        if response.status != 200:
+            raise ValueError("%s: %s" % (query, data.decode("utf-8")))
+        if response.getheader("Content-Type") == "application/json":
+            return json.loads(data.decode("utf-8"))
+        return data
+
+    def info(self):
+        # Fingerprint of the server's closures and its number of categories
+        return self.request("info")
+
+    def closure(self, category, depth):
+        # Category name -> depth below category
+        return self.request("closure", category=category, depth=depth)
+
+    def depth(self, category, root, maxdepth):
+        # Depth of category below root, None if deeper than maxdepth
+        return self.request("depth", category=category, root=root,
+                            maxdepth=maxdepth)["depth"]
+
+    def articles(self, category, depth):
+        ids = PageIdSet()
+        ids.bits = bytearray(self.request("articles", category=category,
+                                          depth=depth))
+        return ids
+
+    def select(self, expression):
+        # Articles of a selection expression, see parse_selection
+        ids = PageIdSet()
+        ids.bits = bytearray(self.request("select", expression=expression))
+        return ids
+
+    def categories(self, page):
+        # Names of the categories page_id is a member of
+        return self.request("categories", page=page)
+
+    def roots(self, page, roots, depth):
+        # The roots whose closure to depth contains page_id
+        return self.request("roots", page=page, root=roots, depth=depth)
+
+    def save_selection(self, path, wantedcategory, maxdepth):
+        data = self.request("selection", category=wantedcategory,
+                            depth=maxdepth)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+        print("%s saved." % path)
+
+
+def job_output_path(name):
+    output_path = os.path.join(OUTPUT_ROOT_PATH, name.replace(" ", "_"))
+    if not os.path.isdir(output_path):
+        try:
+            os.makedirs(output_path)
+        except OSError:
+            print("Creating directories %s failed" % output_path)
+        else:
+            print("Successfully created directories %s" % output_path)
+    return output_path
+
+
+def local_selection(category_graph, closure_cache, pruned, path,
+                    wantedcategory, maxdepth):
+    cat_to_depth = getcategorydepths(category_graph,
+                                     normalize(wantedcategory), maxdepth,
+                                     closure_cache, pruned)
+    save_selection(path, category_graph, cat_to_depth,
+                   {"wantedcategory": wantedcategory, "maxdepth": maxdepth})
+
+
+def select_articles(wantedcategory, maxdepth, fingerprint, build_selection):
+    # For a given starting category and maximum depth get all subcategories
+    # and their depth, save them and collect the ids of their articles.
+    # build_selection(path, wantedcategory, maxdepth) saves the selection of
+    # the closures identified by fingerprint
+    output_path = job_output_path(wantedcategory + "-d" + str(maxdepth))
+    prefix = os.path.join(output_path, wantedcategory.replace(" ", "_"))
+    filepath_articles_xml = prefix + "_articles-d" + str(
+        maxdepth) + OUTPUT_EXTENSIONS[outputCodec]
+    filepath_selection = prefix + "_selection-d" + str(maxdepth) + ".store"
+    manifest = stage_manifest([fingerprint], wantedcategory=wantedcategory,
+                              maxdepth=maxdepth)
+    update = not current_manifest(filepath_selection, manifest)
+    if update:
+        build_selection(filepath_selection, wantedcategory, maxdepth)
+        save_manifest(filepath_selection, manifest)
+    else:
+        print("%s is up to date" % filepath_selection)
+    selection = Selection(filepath_selection)
+    export_selection(selection, prefix, maxdepth, exportFormats, update)
+
+    articleids = PageIdSet()
+    with Stage("Set building", "ids") as stage:
+        articleids.update(selection.member_ids)
+        stage.add(len(selection.member_ids))
+    catid_pair_count = stage.rows
+
+    return filepath_articles_xml, articleids, catid_pair_count
+
+
+# Selection expressions: closures written "Category:depth" (names without
+# spaces, as in jobs), combined with | (union), & (intersection) and
+# - (difference) with the precedence of Python's set operators (- before &
+# before |) and parentheses. Operators are separated from the closures by
+# spaces, so that names may contain them
+SELECTION_OPERATORS = {"|": 1, "&": 2, "-": 3}
+selection_operand_re = re.compile(r"^(\(*)(.+):(\d+)(\)*)$")
+
+
+def selection_tokens(expression):
+    for token in expression.split():
+        if token in SELECTION_OPERATORS or token in "()":
+            yield token
+            continue
+        m = selection_operand_re.match(token)
+        if m is None:
+            raise ValueError("Bad closure in selection %r: %r (expected "
+                             "Category:depth)" % (expression, token))
+        yield from m.group(1)
+        yield normalize(m.group(2)), int(m.group(3))
+        yield from m.group(4)
+
+
+def parse_selection(expression):
+    # Expression tree: (category, depth) closures and (operator, left,
+    # right) nodes
+    tokens = list(selection_tokens(expression))
+    pos = 0
+
+    def parse(precedence):
+        nonlocal pos
+        if pos == len(tokens):
+            raise ValueError("Incomplete selection %r" % expression)
+        token = tokens[pos]
+        pos += 1
+        if token == "(":
+            left = parse(1)
+            if pos == len(tokens) or tokens[pos] != ")":
+                raise ValueError("Missing ) in selection %r" % expression)
+            pos += 1
+        elif isinstance(token, tuple):
+            left = token
+        else:
+            raise ValueError("Unexpected %r in selection %r" % (
+                token, expression))
+        while pos < len(tokens) and tokens[pos] in SELECTION_OPERATORS and \
+                SELECTION_OPERATORS[tokens[pos]] >= precedence:
+            operator = tokens[pos]
+            pos += 1
+            left = (operator, left,
+                    parse(SELECTION_OPERATORS[operator] + 1))
+        return left
+
+    tree = parse(1)
+    if pos != len(tokens):
+        raise ValueError("Unexpected %r in selection %r" % (
+            tokens[pos], expression))
+    return tree
+
+
+def evaluate_selection(tree, articles, closures=None):
+    # articles(category, depth): the PageIdSet of a closure's articles
+    if closures is None:
+        closures = {}
+    if len(tree) == 2:
+        if tree not in closures:
+            closures[tree] = articles(*tree)
+        return closures[tree]
+    operator, left, right = tree
+    left = evaluate_selection(left, articles, closures)
+    right = evaluate_selection(right, articles, closures)
+    if operator == "|":
+        return left | right
+    if operator == "&":
+        return left & right
+    return left - right
+
+
+def closure_articles(category_graph, closure_cache, pruned, category,
+                     maxdepth):
+    articleids = PageIdSet()
+    for cat in getcategorydepths(category_graph, normalize(category),
+                                 maxdepth, closure_cache, pruned):
+        articleids.update(category_graph.members(category_graph.id(cat)))
+    return articleids
+
+
+def select_expression(name, expression, fingerprint, articles):
+    # Evaluate a selection expression into the ids of the articles to
+    # extract, saved as <name>_articleids.store
+    output_path = job_output_path(name)
+    prefix = os.path.join(output_path, name.replace(" ", "_"))
+    filepath_articles_xml = prefix + "_articles" + \
+        OUTPUT_EXTENSIONS[outputCodec]
+    filepath_ids = prefix + "_articleids.store"
+    manifest = stage_manifest([fingerprint], expression=expression)
+    articleids = PageIdSet()
+    if current_manifest(filepath_ids, manifest):
+        print("%s is up to date" % filepath_ids)
+        articleids.update(Store(filepath_ids).array("ids"))
+    else:
+        tree = parse_selection(expression)
+        with Stage("Selection", "closures") as stage:
+            closures = {}
+            articleids = evaluate_selection(tree, articles, closures)
+            stage.add(len(closures))
+        save_store(filepath_ids, {"ids": array("i", articleids)},
+                   {"expression": expression})
+        save_manifest(filepath_ids, manifest)
+    return filepath_articles_xml, articleids, None
+
+
+def load_category_graph():
+    use_sql = os.path.isfile(INPUT_FILEPATH_PAGE_SQL) and \
+              os.path.isfile(INPUT_FILEPATH_CATEGORYLINKS_SQL)
+    FILEPATH_CATEGORY_GRAPH = os.path.join(
+        RESOURCES_PATH,
+        FILENAME_CATEGORY_GRAPH_SQL if use_sql else FILENAME_CATEGORY_GRAPH)
+    # Extract relevant information from the .sql or .csv dumps if they
+    # changed, otherwise map the saved category graph
+    if use_sql:
+        inputs = [INPUT_FILEPATH_PAGE_SQL, INPUT_FILEPATH_CATEGORYLINKS_SQL]
+    else:
+        inputs = [INPUT_FILEPATH_CSV_DUMP]
+    use_page_props = os.path.isfile(INPUT_FILEPATH_PAGE_PROPS_SQL)
+    if use_page_props:
+        inputs.append(INPUT_FILEPATH_PAGE_PROPS_SQL)
+    manifest = stage_manifest([file_fingerprint(path) for path in inputs])
+    if not current_manifest(FILEPATH_CATEGORY_GRAPH, manifest):
+        hidden = None
+        if use_page_props:
+            hidden = hidden_category_ids(INPUT_FILEPATH_PAGE_PROPS_SQL)
+        if use_sql:
+            graph = sqldump_extractor(INPUT_FILEPATH_PAGE_SQL,
+                                      INPUT_FILEPATH_CATEGORYLINKS_SQL,
+                                      hidden, ingestMemoryBytes)
+        else:
+            graph = csvdump_extractor(INPUT_FILEPATH_CSV_DUMP, hidden,
+                                      ingestWorkers, ingestMemoryBytes)
+        graph.save(FILEPATH_CATEGORY_GRAPH)
+        save_manifest(FILEPATH_CATEGORY_GRAPH, manifest)
+    category_graph = CategoryGraph(FILEPATH_CATEGORY_GRAPH)
+    pruned = pruned_categories(category_graph, excludeCategories,
+                               excludeHidden, maxCategoryMembers)
+    fingerprint = pruned_fingerprint(category_graph, pruned)
+    closure_cache = ClosureCache(CLOSURE_CACHE_PATH, fingerprint,
+                                 closureCacheBytes)
+    if reachIndexDepth is not None:
+        path = FILEPATH_CATEGORY_GRAPH + ".reach"
+        manifest = stage_manifest([fingerprint], maxdepth=reachIndexDepth)
+        if not current_manifest(path, manifest):
+            build_reachability_index(path, category_graph, pruned,
+                                     reachIndexDepth,
+                                     {"fingerprint": fingerprint})
+            save_manifest(path, manifest)
+        closure_cache = ReachabilityIndex(path, closure_cache)
+    return category_graph, pruned, closure_cache
+
+
+# Dry run estimates: XML bytes of a page besides its text, and bytes per
+# second read by a scan worker from a .bz2 dump (compressed bytes) or from
+# an uncompressed dump
+DRY_RUN_PAGE_OVERHEAD = 100
+DRY_RUN_SCAN_RATES = {"bz2": 5 * 2 ** 20, "xml": 100 * 2 ** 20}
+
+
+def closure_estimate(graph, levels, wanted=None):
+    # Per level: its categories, the articles first reached at it and their
+    # page_len total; and all the articles. wanted: the articles counted
+    lens = graph.member_lens
+    offsets = graph.member_offsets
+    members = graph.member_ids
+    seen = PageIdSet()
+    rows = []
+    for level in levels:
+        articles = size = 0
+        for id in level:
+            for i in range(offsets[id], offsets[id + 1]):
+                page_id = members[i]
+                if page_id not in seen and \
+                        (wanted is None or page_id in wanted):
+                    seen.add(page_id)
+                    articles += 1
+                    if lens is not None:
+                        size += lens[i]
+        rows.append((len(level), articles, size))
+    return rows, seen
+
+
+def scan_estimate(path_articles_xml, selected, selected_bytes):
+    # Bytes read from the dump, how, and seconds taken by the scan of the
+    # selected articles
+    if path_articles_xml.endswith(".bz2"):
+        rate = DRY_RUN_SCAN_RATES["bz2"]
+        path_index = multistream_index_path(path_articles_xml)
+        if path_index is not None:
+            # Every stream holding a selected page is read whole
+            streams = multistream_offsets(path_index, selected,
+                                          os.path.getsize(path_articles_xml))
+            read = sum(length for offset, length in streams)
+            how = "the %s streams of the selected pages" % len(streams)
+        else:
+            read = os.path.getsize(path_articles_xml)
+            how = "the whole dump"
+    else:
+        rate = DRY_RUN_SCAN_RATES["xml"]
+        if os.path.isfile(catalog_path(path_articles_xml)):
+            read = selected_bytes
+            how = "the selected pages"
+        else:
+            read = os.path.getsize(path_articles_xml)
+            how = "the whole dump, cataloguing its pages"
+    return read, how, read / rate / max(scanWorkers, 1)
+
+
+def print_estimate(rows, per_depth=True):
+    if per_depth:
+        print("Depth  Categories  New articles  Articles  XML MB")
+    articles = size = 0
+    for d, (categories, new, new_size) in enumerate(rows):
+        articles += new
+        size += new_size + DRY_RUN_PAGE_OVERHEAD * new
+        if per_depth:
+            print("%5d  %10d  %12d  %8d  %6.1f" % (d, categories, new,
+                                                    articles, size / 2 ** 20))
+    print("%s categories, %s unique articles, about %.1f MB of XML before "
+          "compression" % (sum(row[0] for row in rows), articles,
+                           size / 2 ** 20))
+    return size
+
+
+def dry_run(category_graph, pruned, closure_cache):
+    # Estimate the selection of every job and the article dump scan from
+    # the category graph alone
+    if category_graph.member_lens is None:
+        print("%s was saved without page sizes, delete it to read them from "
+              "the dumps again" % category_graph.store.path)
+
+    def levels_of(category, depth):
+        root = category_graph.id(normalize(category))
+        if root == -1:
+            print("Category %s not found" % category)
+            return []
+        return cached_closure_levels(category_graph, root, depth,
+                                     closure_cache, pruned)
+
+    selected = PageIdSet()
+    categories = set()
+    for name, selection in jobs:
+        if isinstance(selection, str):
+            closures = {}
+
+            def articles(category, depth):
+                closures[category, depth] = levels_of(category, depth)
+                return closure_estimate(category_graph,
+                                        closures[category, depth])[1]
+
+            ids = evaluate_selection(parse_selection(selection), articles)
+            job_categories = set(id for levels in closures.values()
+                                 for level in levels for id in level)
+            rows, ids = closure_estimate(category_graph,
+                                         [sorted(job_categories)], ids)
+            print("\n%s (%s)" % (name, selection))
+            print_estimate(rows, per_depth=False)
+        else:
+            levels = levels_of(name, selection)
+            rows, ids = closure_estimate(category_graph, levels)
+            job_categories = [id for level in levels for id in level]
+            print("\n%s (Max depth: %s)" % (name, selection))
+            print_estimate(rows)
+        selected |= ids
+        categories.update(job_categories)
+
+    # The dump is read once for all jobs
+    rows, selected = closure_estimate(category_graph, [sorted(categories)],
+                                      selected)
+    print("\nAll jobs")
+    size = print_estimate(rows, per_depth=False)
+    if not os.path.isfile(INPUT_FILEPATH_ARTICLES_XML_BZ2):
+        print("Scan: %s not found" % INPUT_FILEPATH_ARTICLES_XML_BZ2)
+        return
+    read, how, seconds = scan_estimate(INPUT_FILEPATH_ARTICLES_XML_BZ2,
+                                       selected, size)
+    print("Scan: about %.1f MB read from %s (%s) in about %dm %ds with %s "
+          "scan workers" % (read / 2 ** 20, INPUT_FILEPATH_ARTICLES_XML_BZ2,
+                            how, seconds // 60, seconds % 60, scanWorkers))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Extract the articles of Wikipedia categories, as "
+                    "configured by the user inputs at the top of script.py")
+    parser.add_argument(
+        "--dry-run", action="store_true",
+        help="only print the categories, articles and output size of every "
+             "job by depth, and estimate the article dump scan, without "
+             "reading the article dump")
+    return parser.parse_args(argv)
 
 
 def main():
-    FILEPATH_ARTICLES_ID_CAT_CSV = os.path.join(RESOURCES_PATH,
-                                                FILENAME_ARTICLES_ID_CAT_CSV)
-    FILEPATH_CATEGORYLINKS_JSON = os.path.join(RESOURCES_PATH,
-                                               FILENAME_CATEGORYLINKS_JSON)
-    # Extract relevant information from .csv dump if neccessary,
-    # otherwise load category to subcategory dict
-    if not (os.path.isfile(FILEPATH_ARTICLES_ID_CAT_CSV) and
-            os.path.isfile(
-                FILEPATH_CATEGORYLINKS_JSON)):
-        cat_to_subcats_full = csvdump_extractor(INPUT_FILEPATH_CSV_DUMP,
-                                                FILEPATH_ARTICLES_ID_CAT_CSV)
-        save_as_json(cat_to_subcats_full, FILEPATH_CATEGORYLINKS_JSON)
+    args = parse_args()
+    if args.dry_run:
+        dry_run(*load_category_graph())
+        return
+
+    # Ask the graph server for the selections if one is running, otherwise
+    # load the category graph
+    client = None
+    if graphServer is not None:
+        client = GraphClient(graphServer)
+        try:
+            fingerprint = client.info()["fingerprint"]
+        except OSError as e:
+            print("Graph server %s unavailable (%s), loading the category "
+                  "graph" % (graphServer, e))
+            client = None
+    if client is not None:
+        build_selection = client.save_selection
+        articles = client.articles
     else:
-        with open(FILEPATH_CATEGORYLINKS_JSON, "r") as f:
-            cat_to_subcats_full = json.load(f)
+        category_graph, pruned, closure_cache = load_category_graph()
+        fingerprint = pruned_fingerprint(category_graph, pruned)
+        build_selection = partial(local_selection, category_graph,
+                                  closure_cache, pruned)
+        articles = partial(closure_articles, category_graph, closure_cache,
+                           pruned)
 
-    # For a given starting category and maximum depth get all subcategories
-    # and their depth
-    cat_to_depth = getcategorydepths(cat_to_subcats_full, normalize(
-        wantedCategory),
-                                     maxDepth)
-    filepath_cat_to_depth = os.path.join(OUTPUT_PATH,
-                                         wantedCategory.replace(" ", "_")
-                                         + "_category_to_depth-d" + str(
-                                             maxDepth))
-    # save_as_json(cat_to_depth, filepath_cat_to_depth + ".json")
-    save_as_csv(cat_to_depth, filepath_cat_to_depth + ".csv")
-
-    cat_to_subcats = getsubcats(cat_to_subcats_full, cat_to_depth)
-    filepath_cat_to_subcat = os.path.join(OUTPUT_PATH,
-                                          wantedCategory.replace(" ", "_")
-                                          + "_categorylinks-d" + str(maxDepth))
-    # save_as_json(cat_to_subcats, filepath_cat_to_subcat + ".json")
-    save_as_csv(cat_to_subcats, filepath_cat_to_subcat + ".csv")
-
-    # Collect article ids for collected categories
-    filepath_cat_to_artids = os.path.join(OUTPUT_PATH,
-                                          wantedCategory.replace(" ", "_")
-                                          + "_category_to_articleids-d" + str(
-                                              maxDepth))
-    if not os.path.isfile(filepath_cat_to_artids + ".json"):
-        cat_to_articleids = collectArticleIds(FILEPATH_ARTICLES_ID_CAT_CSV,
-                                              cat_to_depth)
-        save_as_json(cat_to_articleids, filepath_cat_to_artids + ".json")
-        save_as_csv(cat_to_articleids, filepath_cat_to_artids + ".csv")
+    # Collect the articles of every job, then copy them from the XML file
+    # into a new XML file per job, or extract them, in a single pass
+    selections = [select_expression(name, selection, fingerprint, articles)
+                  if isinstance(selection, str) else
+                  select_articles(name, selection, fingerprint,
+                                  build_selection)
+                  for name, selection in jobs]
+    if extractorArgs is not None:
+        extracted_counts = extract_articles(
+            INPUT_FILEPATH_ARTICLES_XML_BZ2,
+            [(os.path.dirname(outpath), articleids)
+             for outpath, articleids, count in selections],
+            extractorArgs)
     else:
-        with open(filepath_cat_to_artids + ".json", "r") as f:
-            print("Loading article ids")
-            cat_to_articleids = json.load(f)
-    cat_to_depth.clear()
-    cat_to_subcats.clear()
-
-    articleids = set()
-    catid_pair_count = 0
-    for cat, ids in cat_to_articleids.items():
-        for id in ids:
-            catid_pair_count += 1
-            articleids.add(id)
-    cat_to_articleids.clear()
-
-    # Copy relevant articles from XML file into a new XML file
-    filepath_articles_xml_bz2 = os.path.join(OUTPUT_PATH,
-                                             wantedCategory.replace(" ",
-                                                                    "_") +
-                                             "_articles-d"
-                                             + str(maxDepth) + ".xml.bz2")
-    extracted_count = articlecollector(INPUT_FILEPATH_ARTICLES_XML_BZ2,
-                                       filepath_articles_xml_bz2, articleids)
-
-    print("%s category-articleID pairs found" % catid_pair_count)
-    print("%s unique articleIDs found" % len(articleids))
-    print("%s matching articles extracted" % extracted_count)
+        extracted_counts = articlecollector(
+            INPUT_FILEPATH_ARTICLES_XML_BZ2,
+            [(outpath, articleids)
+             for outpath, articleids, count in selections],
+            scanWorkers, outputCodec, outputCompressLevel, compressThreads,
+            outputShards)
+
+    for (name, selection), (outpath, articleids, catid_pair_count), \
+            extracted_count in zip(jobs, selections, extracted_counts):
+        if isinstance(selection, str):
+            print("\n%s (%s)" % (name, selection))
+        else:
+            print("\n%s (Max depth: %s)" % (name, selection))
+            print("%s category-articleID pairs found" % catid_pair_count)
+        print("%s unique articleIDs found" % len(articleids))
+        print("%s matching articles extracted" % extracted_count)
+
+    if metricsFile is not None:
+        save_as_json({"stages": stage_metrics},
+                     os.path.join(OUTPUT_ROOT_PATH, metricsFile))
 
 
 if __name__ == "__main__":
@@ -2427,16 +2427,16 @@ wgUrlProtocols = [
 EXT_LINK_URL_CLASS = r'[^][<>"\x00-\x20\x7F\s]'
 ANCHOR_CLASS = r'[^][\x00-\x08\x0a-\x1F]'
 ExtLinkBracketedRegex = re.compile(
-    '\[(((?i)' + '|'.join(wgUrlProtocols) + ')' + EXT_LINK_URL_CLASS + r'+)' +
+    '\[((' + '|'.join(wgUrlProtocols) + ')' + EXT_LINK_URL_CLASS + r'+)' +
     r'\s*((?:' + ANCHOR_CLASS + r'|\[\[' + ANCHOR_CLASS + r'+\]\])' + r'*?)\]',
-    re.S | re.U)
+    re.I | re.S | re.U)
 # A simpler alternative:
 # ExtLinkBracketedRegex = re.compile(r'\[(.*?)\](?!])')
 
 EXT_IMAGE_REGEX = re.compile(
     r"""^(http://|https://)([^][<>"\x00-\x20\x7F\s]+)
-    /([A-Za-z0-9_.,~%\-+&;#*?!=()@\x80-\xFF]+)\.((?i)gif|png|jpg|jpeg)$""",
-    re.X | re.S | re.U)
+    /([A-Za-z0-9_.,~%\-+&;#*?!=()@\x80-\xFF]+)\.(gif|png|jpg|jpeg)$""",
+    re.I | re.X | re.S | re.U)
 
 
 def replaceExternalLinks(text):
@@ -2828,7 +2828,7 @@ def pages_from(input):
 
 
 def process_dump(input_file, template_file, out_file, file_size, file_compress,
-                 process_count):
+                 process_count, pages=None):
     """
     :param input_file: name of the wikipedia dump file; '-' to read from stdin
     :param template_file: optional file with template definitions.
@@ -2836,6 +2836,8 @@ def process_dump(input_file, template_file, out_file, file_size, file_compress,
     :param file_size: max size of each extracted file, or None for no max (one file)
     :param file_compress: whether to compress files with bzip.
     :param process_count: number of extraction processes to spawn.
+    :param pages: optional iterable of (id, revid, title, ns, page) tuples, as
+        produced by pages_from(), to extract instead of the pages of input_file.
     """
 
     if input_file == '-':
@@ -2936,8 +2938,10 @@ def process_dump(input_file, template_file, out_file, file_size, file_compress,
         workers.append(extractor)
 
     # Mapper process
+    if pages is None:
+        pages = pages_from(input)
     page_num = 0
-    for page_data in pages_from(input):
+    for page_data in pages:
         id, revid, title, ns, page = page_data
         if keepPage(ns, page):
             # slow down
@@ -3079,8 +3083,12 @@ def reduce_process(opts, output_queue, spool_length,
 # Minimum size of output files
 minFileSize = 200 * 1024
 
-def main():
-
+def parse_options(argv=None):
+    """
+    Parse the command line arguments and set the global options accordingly.
+    :param argv: arguments to parse instead of sys.argv[1:].
+    :return: (args, file_size), or None if the arguments are invalid.
+    """
     parser = argparse.ArgumentParser(prog=os.path.basename(sys.argv[0]),
                                      formatter_class=argparse.RawDescriptionHelpFormatter,
                                      description=__doc__)
@@ -3140,7 +3148,7 @@ def main():
                         version='%(prog)s ' + version,
                         help="print program version")
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     options.keepLinks = args.links
     options.keepSections = args.sections
@@ -3163,7 +3171,7 @@ def main():
             raise ValueError()
     except ValueError:
         logging.error('Insufficient or invalid size: %s', args.bytes)
-        return
+        return None
 
     if args.namespaces:
         options.acceptedNamespaces = set(args.namespaces.split(','))
@@ -3194,11 +3202,21 @@ def main():
     
     createLogger(options.quiet, options.debug)
 
-    input_file = args.input
-
     if not options.keepLinks:
         ignoreTag('a')
 
+    return args, file_size
+
+
+def main():
+
+    parsed = parse_options()
+    if parsed is None:
+        return
+    args, file_size = parsed
+
+    input_file = args.input
+
     # sharing cache of parser templates is too slow:
     # manager = Manager()
     # templateCache = manager.dict()